@@ -1,16 +1,52 @@
 import os
+import asyncio
 import aiohttp
 import logging
 import certifi
+import orjson
 import ssl
 import time
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from datetime import datetime
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Refresh the access token this long before it expires
+TOKEN_REFRESH_MARGIN_SECONDS = 5 * 60
+
+# Create SSL context once using certifi's certificate bundle
+_SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+_SSL_CONTEXT.verify_mode = ssl.CERT_REQUIRED
+_SSL_CONTEXT.check_hostname = True
+
+class UsageData:
+    """eSIM usage data parsed once from the usage endpoint response."""
+    __slots__ = (
+        'status', 'remaining', 'total', 'is_unlimited',
+        'remaining_voice', 'total_voice', 'remaining_text', 'total_text',
+        'expired_at'
+    )
+
+    def __init__(self, status='UNKNOWN', remaining=0, total=0, is_unlimited=False,
+                 remaining_voice=0, total_voice=0, remaining_text=0, total_text=0,
+                 expired_at='N/A'):
+        self.status = status
+        self.remaining = remaining
+        self.total = total
+        self.is_unlimited = is_unlimited
+        self.remaining_voice = remaining_voice
+        self.total_voice = total_voice
+        self.remaining_text = remaining_text
+        self.total_text = total_text
+        self.expired_at = expired_at
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a UsageData instance from the 'data' field of a usage response."""
+        return cls(**{field: data[field] for field in cls.__slots__ if field in data})
+
 class AiraloAPI:
     def __init__(self):
         self.client_id = os.getenv('AIRALO_CLIENT_ID')
@@ -18,103 +54,177 @@ class AiraloAPI:
         if not self.client_id or not self.client_secret:
             raise ValueError("AIRALO_CLIENT_ID and AIRALO_CLIENT_SECRET must be set in environment variables")
             
-        self.base_url = "https://partners-api.airalo.com/v2"
+        self.base_url = "https://partners-api.airalo.com"  # Bound to the shared session
+        self.api_path = "/v2/"  # Prefix for all endpoint paths
         self.token = None
         self.token_expiry = 0
-        self.usage_cache = {}  # Cache for usage data
-        logger.info(f"Initialized AiraloAPI with base_url: {self.base_url}")
+        self._auth_headers = None  # Authorization header for the current token, built once per token
+        self._token_lock = None  # Serializes token refreshes, created lazily inside the event loop
+        self._token_refresh_task = None  # Background task refreshing the token before it expires
+        self.usage_cache = TTLCache(maxsize=10_000, ttl=60)  # Usage data per ICCID, kept for 60 seconds
+        self.topup_cache = TTLCache(maxsize=5000, ttl=300)  # Topup packages per ICCID, kept for 5 minutes
+        self._topup_lookups = TTLCache(maxsize=10_000, ttl=300)  # Recent topup lookup counts per ICCID
+        self._session = None  # Shared HTTP session, created lazily inside the event loop
+        self._inflight = {}  # Maps (endpoint, iccid) to the task of an in-flight request
+        logger.info("Initialized AiraloAPI with base_url: %s%s", self.base_url, self.api_path)
 
-    async def _get_token(self):
-        """Get or refresh the access token."""
-        current_time = time.time()
+    async def _session_get(self):
+        """Get the shared HTTP session, creating it on first use."""
+        if self._session is None or self._session.closed:
+            # All traffic goes to a single host, so keep a small warm pool and cache DNS
+            connector = aiohttp.TCPConnector(
+                limit=20,
+                limit_per_host=20,
+                use_dns_cache=True,
+                ttl_dns_cache=600,
+                keepalive_timeout=75,
+                enable_cleanup_closed=True,
+                ssl=_SSL_CONTEXT
+            )
+            self._session = aiohttp.ClientSession(
+                base_url=self.base_url,
+                headers={'Accept': 'application/json'},
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=30, connect=5)
+            )
+        return self._session
+
+    async def aclose(self):
+        """Stop in-flight requests and close the shared HTTP session."""
+        # Stop shared requests before they run against a closed session
+        inflight = list(self._inflight.values())
+        for task in inflight:
+            task.cancel()
+        await asyncio.gather(*inflight, return_exceptions=True)
         
+        if self._token_refresh_task is not None:
+            self._token_refresh_task.cancel()
+            self._token_refresh_task = None
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def warmup(self):
+        """Open a pooled connection and fetch the access token ahead of the first user request."""
+        try:
+            await self._get_token()
+        except Exception as e:
+            # Not fatal; the first request will retry the token fetch
+            logger.warning("Airalo warmup failed: %s", e)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    async def _get_token(self, force=False):
+        """Get or refresh the access token."""
         # If we have a valid token, return it
-        if self.token and current_time < self.token_expiry:
+        if not force and self.token and time.time() < self.token_expiry:
             return self.token
 
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+
+        async with self._token_lock:
+            # Another caller may have refreshed the token while we waited
+            if not force and self.token and time.time() < self.token_expiry:
+                return self.token
+
+            token = await self._fetch_token()
+
+        # Keep the token fresh in the background so user requests never wait on it
+        if self._token_refresh_task is None or self._token_refresh_task.done():
+            self._token_refresh_task = asyncio.create_task(self._refresh_token_loop())
+        return token
+
+    async def _refresh_token_loop(self):
+        """Refresh the access token shortly before it expires."""
+        while True:
+            await asyncio.sleep(max(0, self.token_expiry - time.time() - TOKEN_REFRESH_MARGIN_SECONDS))
+            try:
+                await self._get_token(force=True)
+            except Exception as e:
+                # The user path will still refresh on demand; try again in a minute
+                logger.error("Background token refresh failed: %s", e)
+                await asyncio.sleep(60)
+
+    async def _fetch_token(self):
+        """Request a new access token from the API."""
+        current_time = time.time()
+
         # Request new token
-        url = f"{self.base_url}/token"
+        path = self.api_path + "token"
         data = {
             'client_id': self.client_id,
             'client_secret': self.client_secret,
             'grant_type': 'client_credentials'
         }
-        headers = {
-            'Accept': 'application/json'
-        }
 
-        # Create SSL context using certifi's certificate bundle
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        ssl_context.verify_mode = ssl.CERT_REQUIRED
-        ssl_context.check_hostname = True
-
-        timeout = aiohttp.ClientTimeout(total=30)  # 30 seconds timeout
-
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            try:
-                async with session.post(url, data=data, headers=headers, ssl=ssl_context) as response:
-                    if response.status == 200:
-                        response_data = await response.json()
-                        self.token = response_data['data']['access_token']
-                        # Set expiry to 23 hours to be safe (token is valid for 24 hours)
-                        self.token_expiry = current_time + (23 * 60 * 60)
-                        logger.info("Successfully obtained new access token")
-                        return self.token
-                    else:
-                        error_msg = f"Failed to get access token: {response.status}"
-                        logger.error(error_msg)
-                        raise Exception(error_msg)
-            except Exception as e:
-                error_msg = f"Error getting access token: {str(e)}"
-                logger.error(error_msg)
-                raise Exception(error_msg)
+        session = await self._session_get()
+        try:
+            async with session.post(path, data=data) as response:
+                if response.status == 200:
+                    response_data = await response.json(loads=orjson.loads)
+                    self.token = response_data['data']['access_token']
+                    self._auth_headers = {'Authorization': f'Bearer {self.token}'}
+                    # Set expiry to 23 hours to be safe (token is valid for 24 hours)
+                    self.token_expiry = current_time + (23 * 60 * 60)
+                    logger.info("Successfully obtained new access token")
+                    return self.token
+                else:
+                    error_msg = f"Failed to get access token: {response.status}"
+                    logger.error(error_msg)
+                    raise Exception(error_msg)
+        except Exception as e:
+            error_msg = f"Error getting access token: {str(e)}"
+            logger.error(error_msg)
+            raise Exception(error_msg)
 
     async def _make_request(self, method, endpoint, **kwargs):
         """Make an authenticated request to the API."""
         # Get or refresh token
-        token = await self._get_token()
+        await self._get_token()
         
-        # Add authorization header
-        headers = kwargs.get('headers', {})
-        headers['Authorization'] = f'Bearer {token}'
-        headers['Accept'] = 'application/json'
-        kwargs['headers'] = headers
-
-        # Create SSL context using certifi's certificate bundle
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        ssl_context.verify_mode = ssl.CERT_REQUIRED
-        ssl_context.check_hostname = True
-        kwargs['ssl'] = ssl_context
-
-        # Add timeout
-        kwargs['timeout'] = aiohttp.ClientTimeout(total=30)
+        # Add authorization header; Accept is set on the session
+        if 'headers' in kwargs:
+            kwargs['headers'] = {**kwargs['headers'], **self._auth_headers}
+        else:
+            kwargs['headers'] = self._auth_headers
 
-        url = f"{self.base_url}/{endpoint}"
-        logger.info(f"Making {method} request to {url}")
+        path = self.api_path + endpoint
+        logger.info("Making %s request to %s", method, path)
 
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.request(method, url, **kwargs) as response:
-                    return await self._handle_response(response)
-            except Exception as e:
-                error_msg = f"API request failed: {str(e)}"
-                logger.error(error_msg)
-                raise Exception(error_msg)
+        session = await self._session_get()
+        try:
+            async with session.request(method, path, **kwargs) as response:
+                return await self._handle_response(response)
+        except Exception as e:
+            error_msg = f"API request failed: {str(e)}"
+            logger.error(error_msg)
+            raise Exception(error_msg)
 
     async def _handle_response(self, response):
         """Handle API response and extract error messages."""
-        response_text = await response.text()
-        logger.info(f"Response status: {response.status}")
-        logger.info(f"Response body: {response_text}")
+        logger.info("Response status: %s", response.status)
+        if logger.isEnabledFor(logging.DEBUG):
+            response_text = await response.text()
+            logger.debug("Response body: %s", response_text)
 
         try:
-            response_data = await response.json()
+            response_data = await response.json(loads=orjson.loads, content_type=None)
         except:
             response_data = {}
 
         if response.status == 200:
             return response_data
-        elif response.status in [401, 403, 404]:
+
+        # Keep error bodies visible at INFO for diagnosing failed requests
+        if not logger.isEnabledFor(logging.DEBUG):
+            logger.info("Response body: %s", response_data)
+
+        if response.status in [401, 403, 404]:
             # Standardize error message for any case where we can't access the ICCID
             error_msg = "Invalid ICCID. This eSIM is not available on our platform."
             logger.error(error_msg)
@@ -135,12 +245,45 @@ class AiraloAPI:
             logger.error(error_msg)
             raise Exception(error_msg)
 
+    async def _coalesced_request(self, key, method, endpoint):
+        """Make a request, sharing the result with concurrent callers using the same key."""
+        # If the same request is already in flight, wait for its result instead
+        task = self._inflight.get(key)
+        if task is None:
+            # The request runs in its own task, so a cancelled caller doesn't cancel it for the others
+            task = asyncio.create_task(self._make_request(method, endpoint))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish_inflight(key, done))
+        return await asyncio.shield(task)
+
+    def _finish_inflight(self, key, task):
+        """Done callback that forgets a finished shared request."""
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception as retrieved in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
     async def get_topup_packages(self, iccid: str):
         """Get available top-up packages for an eSIM."""
         if not iccid:
             raise ValueError("ICCID cannot be empty")
 
-        return await self._make_request('GET', f"sims/{iccid}/topups")
+        # Check cache first
+        cached = self.topup_cache.get(iccid)
+        if cached is not None:
+            return cached
+
+        # Only cache ICCIDs that are looked up repeatedly, so one-off typos
+        # and invalid ICCIDs don't push real users' entries out of the cache
+        lookups = self._topup_lookups.get(iccid, 0) + 1
+        self._topup_lookups[iccid] = lookups
+
+        data = await self._coalesced_request(('topups', iccid), 'GET', f"sims/{iccid}/topups")
+
+        if lookups > 1:
+            self.topup_cache[iccid] = data
+        return data
 
     async def get_usage(self, iccid: str):
         """Get eSIM usage data with caching."""
@@ -148,14 +291,14 @@ class AiraloAPI:
             raise ValueError("ICCID cannot be empty")
 
         # Check cache first
-        cache_key = f"{iccid}_{datetime.now().strftime('%Y%m%d%H%M')}"
-        if cache_key in self.usage_cache:
-            return self.usage_cache[cache_key]
+        cached = self.usage_cache.get(iccid)
+        if cached is not None:
+            return cached
 
-        data = await self._make_request('GET', f"sims/{iccid}/usage")
+        data = await self._coalesced_request(('usage', iccid), 'GET', f"sims/{iccid}/usage")
         
         # Cache the response
-        self.usage_cache[cache_key] = data
+        self.usage_cache[iccid] = data
         return data
 
     async def submit_topup_order(self, package_id: str, iccid: str, description: str = None):
@@ -177,7 +320,7 @@ class AiraloAPI:
         else:
             data['description'] = f"Topup ({iccid})"
             
-        logger.info(f"Submitting topup order for ICCID {iccid} with package {package_id}")
+        logger.info("Submitting topup order for ICCID %s with package %s", iccid, package_id)
         
         # Make the POST request
         return await self._make_request('POST', "orders/topups", data=data) 
\ No newline at end of file
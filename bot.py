@@ -2,12 +2,21 @@ import os
 import logging
 import dotenv
 import asyncio
+import aiohttp
+import heapq
+import certifi
+import functools
 import math
-import requests
+import orjson
+import random
+import re
+import ssl
 import time
+from cachetools import TTLCache
+from decimal import Decimal, ROUND_CEILING
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-from airalo_api import AiraloAPI
+from airalo_api import AiraloAPI, UsageData
 from solana_payments import get_payment_manager, SPL_TOKEN_SYMBOL
 
 # Load environment variables
@@ -32,20 +41,167 @@ TEST_TOKEN_AMOUNT = 1  # Always require just 1 token for testing
 # Get token address from environment variable
 SPL_TOKEN_MINT = os.getenv('SPL_TOKEN_MINT', '3zJ7RxtzPahndBTEn5PGUyo9xBMv6MJP9J4TPqdFpump')
 
+# Payment polling backoff (seconds)
+PAYMENT_POLL_INITIAL_DELAY = 5.0
+PAYMENT_POLL_MAX_DELAY = 30.0
+PAYMENT_POLL_BACKOFF = 1.6
+PAYMENT_POLL_BATCH_SIZE = 10  # Payments checked concurrently per poller wakeup
+
 # Price markup configuration
 PRICE_MARKUP_MULTIPLIER = 1.69  # Markup all prices by 1.69x
 
+# Emoji shown next to each eSIM status in usage replies
+STATUS_EMOJI = {
+    'ACTIVE': '✅',
+    'NOT_ACTIVE': '❌',
+    'FINISHED': '🏁',
+    'UNKNOWN': '❓',
+    'EXPIRED': '⏰'
+}
+
+# Buttons shown under the welcome message for /start and /help
+WELCOME_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📊 Check Usage", callback_data='check_usage'),
+        InlineKeyboardButton("🔋 Top Up Data", callback_data='topup_flow')
+    ]
+])
+
+# Payment instructions sent after a package is selected (Markdown)
+PAYMENT_MESSAGE_TEMPLATE = (
+    "📦 Selected package: {package_id}\n"
+    "💰 Price: ${price}\n\n"
+    "Please send exactly {token_amount} " + SPL_TOKEN_SYMBOL + " tokens to complete your payment:\n\n"
+    "`{address}`\n\n"
+    "⏱️ Payment window: {expires_at}\n"
+    "(You have {minutes} minutes and {seconds} seconds to complete payment)"
+)
+
+# Parses topup callback data in one pass:
+#   topup_usage_<iccid>
+#   topup_<package_id>_<original_price_cents>
+#   topup_<package_id>_<original_price>[_<marked_up_price>]  (legacy, prices in dollars)
+TOPUP_CALLBACK_RE = re.compile(
+    r'^topup_(?:usage_(?P<usage_iccid>.+)'
+    r'|(?P<package_id>[^_]+)_(?:(?P<price_cents>\d+)'
+    r'|(?P<original_price>\d+\.\d*)(?:_(?P<marked_up_price>[\d.]+))?))$'
+)
+
+# Check Payment button callback data is this prefix followed by the payment address
+CHECK_PAYMENT_CALLBACK_PREFIX = 'check_payment_'
+
+class PaymentRegistry:
+    """In-memory registry of payments being polled, ordered by next check time.
+
+    The poller only goes through this interface, so a shared store can replace
+    it once payments themselves are persisted outside this process.
+    """
+    def __init__(self):
+        self._watches = {}  # Maps payment address to its polling state
+        self._schedule = []  # Heap of (next_check_time, payment_address)
+        self._event = None  # Wakes the poller when a payment is added
+
+    def add(self, payment_address, watch, next_check):
+        """Start tracking a payment, first checking it at next_check."""
+        self._watches[payment_address] = watch
+        self.reschedule(payment_address, next_check)
+
+        # Wake the poller in case this check is due sooner than anything else
+        if self._event is not None:
+            self._event.set()
+
+    def get(self, payment_address):
+        """Get a payment's polling state, or None if it isn't tracked."""
+        return self._watches.get(payment_address)
+
+    def remove(self, payment_address):
+        """Stop tracking a payment."""
+        self._watches.pop(payment_address, None)
+
+    def reschedule(self, payment_address, next_check):
+        """Schedule the next check for a tracked payment, replacing any earlier schedule."""
+        self._watches[payment_address]['next_check'] = next_check
+        heapq.heappush(self._schedule, (next_check, payment_address))
+
+    def requeue(self, payment_addresses, next_check):
+        """Reschedule popped payments that were neither rescheduled nor removed since."""
+        for payment_address in payment_addresses:
+            watch = self._watches.get(payment_address)
+            if watch is not None and watch['next_check'] is None:
+                self.reschedule(payment_address, next_check)
+
+    def wake(self, payment_address):
+        """Check a tracked payment as soon as possible, e.g. after its token account changed."""
+        watch = self._watches.get(payment_address)
+        if watch is None:
+            return
+        if watch['next_check'] is None:
+            # A check is already running; it reschedules the payment right away when it ends
+            watch['woken'] = True
+            return
+        self.reschedule(payment_address, time.time())
+        if self._event is not None:
+            self._event.set()
+
+    def pop_due(self, now, limit):
+        """Remove and return up to limit tracked payment addresses due by now.
+
+        A popped payment has no next check until it is rescheduled or requeued.
+        """
+        due = []
+        while self._schedule and self._schedule[0][0] <= now and len(due) < limit:
+            next_check, payment_address = heapq.heappop(self._schedule)
+            # Entries superseded by a later reschedule are skipped
+            watch = self._watches.get(payment_address)
+            if watch is not None and watch['next_check'] == next_check:
+                watch['next_check'] = None
+                due.append(payment_address)
+        return due
+
+    async def wait_for_due(self):
+        """Wait until the next check is due or a new payment is added."""
+        if self._event is None:
+            self._event = asyncio.Event()
+
+        timeout = self._schedule[0][0] - time.time() if self._schedule else None
+        self._event.clear()
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
 # In-memory payment tracking
 payment_checks = {}  # Maps chat_id to payment address
-payment_tasks = {}   # Maps payment address to asyncio task
+payment_registry = PaymentRegistry()  # Payments polled by the background payment poller
+payment_tasks = set()  # Running per-payment handlers started by the poller
+background_tasks = set()  # Long-running tasks started in startup(), cancelled in shutdown()
+
+# Rendered topup package keyboards per ICCID, kept for 60 seconds
+topup_keyboard_cache = TTLCache(maxsize=5000, ttl=60)
+
+# Shared HTTP session for outbound requests, created lazily inside the event loop
+_http_session = None
+
+# Serializes token price fetches so concurrent cache misses make one request
+_price_lock = None
+
+# Background refresh of a stale token price, so only one runs at a time
+_price_refresh_task = None
 
 # Token price cache to avoid frequent API calls
 token_price_cache = {
     'price': None,
     'timestamp': 0,
-    'cache_duration': 300  # Cache for 5 minutes (300 seconds)
+    'cache_duration': 300,  # Cache for 5 minutes (300 seconds)
+    'stale_duration': 600,  # Serve a stale price while refreshing for up to 10 minutes
+    'failures': 0,  # Consecutive failed fetches
+    'retry_at': 0  # Don't fetch again before this time after a failure
 }
 
+# Token price fetch retry backoff after failures (seconds)
+PRICE_RETRY_BASE_DELAY = 30
+PRICE_RETRY_MAX_DELAY = 300
+
 def round_price_to_95_cents(price):
     """Round a price to end with .95 cents.
     
@@ -59,71 +215,209 @@ def round_price_to_95_cents(price):
     result = base_price + 0.95
     return result
 
-def get_token_price_usd():
+@functools.lru_cache(maxsize=4096)
+def get_marked_up_price(original_price):
+    """Get the .95-rounded customer price for an original package price.
+
+    Package prices repeat across renders and clicks, so the markup is
+    computed once per distinct price.
+    """
+    return round_price_to_95_cents(original_price * PRICE_MARKUP_MULTIPLIER)
+
+async def get_http_session():
+    """Get the shared HTTP session, creating it on first use."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        # Only DexScreener is called through this session, so keep a small warm pool and cache DNS
+        connector = aiohttp.TCPConnector(
+            limit=32,
+            limit_per_host=8,
+            use_dns_cache=True,
+            ttl_dns_cache=600,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+            ssl=ssl.create_default_context(cafile=certifi.where())
+        )
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=10, connect=5)
+        )
+    return _http_session
+
+async def close_http_session():
+    """Close the shared HTTP session."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+def get_cached_token_price():
+    """Return the cached token price if it is still valid, otherwise None."""
+    if token_price_cache['price'] and (int(time.time()) - token_price_cache['timestamp'] < token_price_cache['cache_duration']):
+        return token_price_cache['price']
+    return None
+
+def get_stale_token_price():
+    """Return the cached token price if it is expired but still servable, otherwise None."""
+    if token_price_cache['price'] and (int(time.time()) - token_price_cache['timestamp'] < token_price_cache['stale_duration']):
+        return token_price_cache['price']
+    return None
+
+async def refresh_token_price():
+    """Refresh the token price under the price lock unless another caller already did."""
+    global _price_lock
+    if _price_lock is None:
+        _price_lock = asyncio.Lock()
+
+    async with _price_lock:
+        # Another caller may have refreshed the price while we waited
+        price = get_cached_token_price()
+        if price:
+            return price
+
+        # Back off after failed fetches instead of hitting DexScreener on every call
+        if time.time() < token_price_cache['retry_at']:
+            return get_fallback_token_price()
+        return await fetch_token_price_usd()
+
+async def get_token_price_usd():
+    """Get the current token price in USD, fetching it from DexScreener if the cache is stale.
+
+    A price that has expired but is still within the stale window is returned
+    immediately while a background task refreshes it (stale-while-revalidate).
+    """
+    global _price_refresh_task
+
+    # Check if we have a cached price that's still valid
+    price = get_cached_token_price()
+    if price:
+        logger.info("Using cached token price: $%s", price)
+        return price
+
+    price = get_stale_token_price()
+    if price:
+        if _price_refresh_task is None or _price_refresh_task.done():
+            _price_refresh_task = asyncio.create_task(refresh_token_price())
+        logger.info("Using stale token price while refreshing: $%s", price)
+        return price
+
+    return await refresh_token_price()
+
+async def fetch_token_price_usd():
     """Fetch the current token price in USD from DexScreener API."""
     current_time = int(time.time())
     
-    # Check if we have a cached price that's still valid
-    if token_price_cache['price'] and (current_time - token_price_cache['timestamp'] < token_price_cache['cache_duration']):
-        logger.info(f"Using cached token price: ${token_price_cache['price']}")
-        return token_price_cache['price']
-    
     try:
         # Fetch the token price from DexScreener API
         url = f"https://api.dexscreener.com/tokens/v1/solana/{SPL_TOKEN_MINT}"
-        response = requests.get(url, timeout=10)
+        session = await get_http_session()
+        async with session.get(url) as response:
+            status = response.status
+            if status == 200:
+                data = await response.json(loads=orjson.loads, content_type=None)
+            else:
+                response_text = await response.text()
         
-        if response.status_code == 200:
-            data = response.json()
-            if data and isinstance(data, list) and len(data) > 0:
-                # Extract the price from the response
-                price_usd = float(data[0].get('priceUsd', 0))
-                
+        if status == 200:
+            try:
+                # Extract the price from the response, which is a list of pairs
+                price_usd = float(data[0].get('priceUsd', 0) or 0)
+            except (TypeError, IndexError, KeyError, AttributeError, ValueError):
+                logger.error("Invalid response format from DexScreener API")
+            else:
                 if price_usd > 0:
                     # Update the cache
                     token_price_cache['price'] = price_usd
                     token_price_cache['timestamp'] = current_time
+                    token_price_cache['failures'] = 0
                     
-                    logger.info(f"Fetched token price: ${price_usd}")
+                    logger.info("Fetched token price: $%s", price_usd)
                     return price_usd
                 else:
                     logger.error("Token price from API is zero or invalid")
-            else:
-                logger.error("Invalid response format from DexScreener API")
         else:
-            logger.error(f"Failed to fetch token price: {response.status_code} - {response.text}")
+            logger.error("Failed to fetch token price: %s - %s", status, response_text)
     
     except Exception as e:
-        logger.error(f"Error fetching token price: {str(e)}")
+        logger.error("Error fetching token price: %s", e)
     
+    # Retry sooner after a transient error, backing off exponentially if it persists
+    token_price_cache['failures'] += 1
+    delay = min(PRICE_RETRY_BASE_DELAY * 2 ** (token_price_cache['failures'] - 1), PRICE_RETRY_MAX_DELAY)
+    token_price_cache['retry_at'] = current_time + delay
+    
+    return get_fallback_token_price()
+
+def get_fallback_token_price():
+    """Get the price to use when a fresh one couldn't be fetched."""
     # Return a default price if we couldn't fetch a new one
     # If we had a cached price previously, use that as a fallback
     if token_price_cache['price']:
-        logger.warning(f"Using expired cached token price as fallback: ${token_price_cache['price']}")
+        logger.warning("Using expired cached token price as fallback: $%s", token_price_cache['price'])
         return token_price_cache['price']
     
     # If all else fails, use a hardcoded fallback price
     fallback_price = 0.001333  # Default fallback price
-    logger.warning(f"Using hardcoded fallback token price: ${fallback_price}")
+    logger.warning("Using hardcoded fallback token price: $%s", fallback_price)
     return fallback_price
 
-def calculate_token_amount(usd_price):
+async def calculate_token_amount(usd_price):
     """Convert USD price to token amount, rounded up to the nearest whole token."""
-    token_price_usd = get_token_price_usd()
+    token_price_usd = await get_token_price_usd()
     if token_price_usd <= 0:
-        logger.error(f"Invalid token price: ${token_price_usd}")
+        logger.error("Invalid token price: $%s", token_price_usd)
         # Use a fallback price to avoid division by zero
         token_price_usd = 0.001333
     
-    # Calculate how many tokens equal the USD price
-    token_amount = usd_price / token_price_usd
+    # Calculate how many tokens equal the USD price using exact decimal arithmetic,
+    # so float error (e.g. 5.000000000000001) can't round up to an extra token
+    token_amount = Decimal(str(usd_price)) / Decimal(str(token_price_usd))
     
     # Round up to the nearest whole token
-    token_amount = math.ceil(token_amount)
+    token_amount = int(token_amount.to_integral_value(rounding=ROUND_CEILING))
     
-    logger.info(f"Price conversion: ${usd_price} at token price ${token_price_usd} = {token_amount} {SPL_TOKEN_SYMBOL}")
+    logger.info("Price conversion: $%s at token price $%s = %s %s", usd_price, token_price_usd, token_amount, SPL_TOKEN_SYMBOL)
     return token_amount
 
+def build_topup_keyboard(packages):
+    """Build the package selection keyboard, showing marked up prices."""
+    keyboard = []
+    for package in packages:
+        # Apply price markup
+        original_price = float(package['net_price'])
+        marked_up_price = get_marked_up_price(original_price)
+        
+        # Store the original price in cents; the marked up price is derived from it
+        button_text = f"{package['title']} - ${marked_up_price:.2f}"
+        callback_data = f"topup_{package['id']}_{round(original_price * 100)}"
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
+
+    return InlineKeyboardMarkup(keyboard)
+
+async def get_topup_keyboard(iccid):
+    """Get the package selection keyboard for an ICCID, or None if it has no packages.
+
+    Keyboards are cached briefly so the usage -> topup flow and repeated
+    clicks don't refetch and re-render the same packages.
+    """
+    reply_markup = topup_keyboard_cache.get(iccid)
+    if reply_markup is None:
+        response = await airalo_api.get_topup_packages(iccid)
+        packages = response.get('data', [])
+        if not packages:
+            return None
+
+        reply_markup = build_topup_keyboard(packages)
+        topup_keyboard_cache[iccid] = reply_markup
+    return reply_markup
+
+@functools.lru_cache(maxsize=1024)
+def get_usage_topup_markup(iccid):
+    """Get the Top Up Data button shown under a usage reply for an ICCID."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔋 Top Up Data", callback_data=f"topup_usage_{iccid}")]
+    ])
+
 def get_welcome_message(user):
     """Generate welcome message for both start and help commands."""
     return (
@@ -137,26 +431,12 @@ def get_welcome_message(user):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
     user = update.effective_user
-    keyboard = [
-        [
-            InlineKeyboardButton("📊 Check Usage", callback_data='check_usage'),
-            InlineKeyboardButton("🔋 Top Up Data", callback_data='topup_flow')
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(get_welcome_message(user), reply_markup=reply_markup)
+    await update.message.reply_text(get_welcome_message(user), reply_markup=WELCOME_MARKUP)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /help is issued."""
     user = update.effective_user
-    keyboard = [
-        [
-            InlineKeyboardButton("📊 Check Usage", callback_data='check_usage'),
-            InlineKeyboardButton("🔋 Top Up Data", callback_data='topup_flow')
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(get_welcome_message(user), reply_markup=reply_markup)
+    await update.message.reply_text(get_welcome_message(user), reply_markup=WELCOME_MARKUP)
 
 async def topup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle service topup requests."""
@@ -203,65 +483,38 @@ async def handle_iccid_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if context.user_data.get('awaiting_usage'):
             # Handle usage check
             response = await airalo_api.get_usage(iccid)
-            usage_data = response.get('data', {})
+            usage_data = UsageData.from_dict(response.get('data', {}))
             
             # Format usage message
-            status_emoji = {
-                'ACTIVE': '✅',
-                'NOT_ACTIVE': '❌',
-                'FINISHED': '🏁',
-                'UNKNOWN': '❓',
-                'EXPIRED': '⏰'
-            }.get(usage_data.get('status', 'UNKNOWN'), '❓')
+            status_emoji = STATUS_EMOJI.get(usage_data.status, '❓')
 
             message = (
-                f"{status_emoji} eSIM Status: {usage_data.get('status', 'UNKNOWN')}\n\n"
+                f"{status_emoji} eSIM Status: {usage_data.status}\n\n"
                 f"📊 Data Usage:\n"
-                f"• Remaining: {usage_data.get('remaining', 0)} MB\n"
-                f"• Total: {usage_data.get('total', 0)} MB\n"
-                f"• Unlimited: {'Yes' if usage_data.get('is_unlimited') else 'No'}\n\n"
+                f"• Remaining: {usage_data.remaining} MB\n"
+                f"• Total: {usage_data.total} MB\n"
+                f"• Unlimited: {'Yes' if usage_data.is_unlimited else 'No'}\n\n"
                 f"📞 Voice:\n"
-                f"• Remaining: {usage_data.get('remaining_voice', 0)} minutes\n"
-                f"• Total: {usage_data.get('total_voice', 0)} minutes\n\n"
+                f"• Remaining: {usage_data.remaining_voice} minutes\n"
+                f"• Total: {usage_data.total_voice} minutes\n\n"
                 f"💬 Text:\n"
-                f"• Remaining: {usage_data.get('remaining_text', 0)} messages\n"
-                f"• Total: {usage_data.get('total_text', 0)} messages\n\n"
-                f"⏰ Expires: {usage_data.get('expired_at', 'N/A')}"
+                f"• Remaining: {usage_data.remaining_text} messages\n"
+                f"• Total: {usage_data.total_text} messages\n\n"
+                f"⏰ Expires: {usage_data.expired_at}"
             )
             
             # Add Top Up button
-            keyboard = [[InlineKeyboardButton("🔋 Top Up Data", callback_data=f"topup_usage_{iccid}")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.message.reply_text(message, reply_markup=reply_markup)
+            await update.message.reply_text(message, reply_markup=get_usage_topup_markup(iccid))
         else:
             # Handle topup packages (existing code)
-            response = await airalo_api.get_topup_packages(iccid)
-            packages = response.get('data', [])
+            reply_markup = await get_topup_keyboard(iccid)
 
-            if not packages:
+            if reply_markup is None:
                 await update.message.reply_text(
                     "No top-up packages found for this eSIM. Please check your ICCID and try again."
                 )
                 return
 
-            keyboard = []
-            for package in packages:
-                # Apply price markup
-                original_price = float(package['net_price'])
-                
-                # Calculate marked up price
-                raw_marked_up = original_price * PRICE_MARKUP_MULTIPLIER
-                
-                # Round to .95 cents
-                marked_up_price = round_price_to_95_cents(raw_marked_up)
-                
-                # Store both the original and marked up price in the callback data
-                button_text = f"{package['title']} - ${marked_up_price:.2f}"
-                callback_data = f"topup_{package['id']}_{original_price}_{marked_up_price}"
-                keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
             await update.message.reply_text(
                 "Available top-up packages:",
                 reply_markup=reply_markup
@@ -274,7 +527,7 @@ async def handle_iccid_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     except Exception as e:
         error_message = str(e)
-        logger.error(f"Error fetching data: {error_message}")
+        logger.error("Error fetching data: %s", error_message)
         
         if "Invalid ICCID" in error_message:
             await update.message.reply_text(error_message)
@@ -293,9 +546,6 @@ async def handle_topup_selection(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
 
-    if not query.data.startswith('topup_'):
-        return
-
     # Check if this is a topup from usage message or welcome message
     if query.data in ['topup_flow', 'topup_usage']:
         context.user_data['awaiting_iccid'] = True
@@ -304,66 +554,49 @@ async def handle_topup_selection(update: Update, context: ContextTypes.DEFAULT_T
         )
         return
 
+    match = TOPUP_CALLBACK_RE.match(query.data)
+    if not match:
+        logger.warning("Unrecognized topup callback data: %s", query.data)
+        return
+
     # Check if this is a topup from usage message
-    if query.data.startswith('topup_usage_'):
-        iccid = query.data.split('_')[2]
+    if match['usage_iccid']:
+        iccid = match['usage_iccid']
         context.user_data['iccid'] = iccid
         # Fetch topup packages for this ICCID
         try:
-            response = await airalo_api.get_topup_packages(iccid)
-            packages = response.get('data', [])
+            reply_markup = await get_topup_keyboard(iccid)
 
-            if not packages:
+            if reply_markup is None:
                 await query.message.reply_text(
                     "No top-up packages found for this eSIM. Please check your ICCID and try again."
                 )
                 return
 
-            keyboard = []
-            for package in packages:
-                # Apply price markup
-                original_price = float(package['net_price'])
-                
-                # Calculate marked up price
-                raw_marked_up = original_price * PRICE_MARKUP_MULTIPLIER
-                
-                # Round to .95 cents
-                marked_up_price = round_price_to_95_cents(raw_marked_up)
-                
-                # Store both the original and marked up price in the callback data
-                button_text = f"{package['title']} - ${marked_up_price:.2f}"
-                callback_data = f"topup_{package['id']}_{original_price}_{marked_up_price}"
-                keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
             await query.message.reply_text(
                 "Available top-up packages:",
                 reply_markup=reply_markup
             )
         except Exception as e:
             error_message = str(e)
-            logger.error(f"Error fetching topup packages: {error_message}")
+            logger.error("Error fetching topup packages: %s", error_message)
             await query.message.reply_text(error_message)
         return
 
     # Handle regular topup package selection
-    # Check if we have the marked up price in callback data
-    callback_parts = query.data.split('_')
-    if len(callback_parts) == 4:
-        # New format with original and marked up price
-        _, package_id, original_price, marked_up_price = callback_parts
-        original_price_float = float(original_price)
-        marked_up_price_float = float(marked_up_price)
+    package_id = match['package_id']
+    if match['price_cents']:
+        original_price_float = int(match['price_cents']) / 100
     else:
-        # Old format with just the original price
-        _, package_id, original_price = callback_parts
-        original_price_float = float(original_price)
-        
-        # Calculate marked up price
-        raw_marked_up = original_price_float * PRICE_MARKUP_MULTIPLIER
-        
-        # Round to .95 cents
-        marked_up_price_float = round_price_to_95_cents(raw_marked_up)
+        # Legacy format with prices in dollars, from keyboards sent before the cents format
+        original_price_float = float(match['original_price'])
+
+    if match['marked_up_price']:
+        # Legacy format with original and marked up price
+        marked_up_price_float = float(match['marked_up_price'])
+    else:
+        # Calculate marked up price, rounded to .95 cents
+        marked_up_price_float = get_marked_up_price(original_price_float)
     
     # Store selected package in user data with both prices
     context.user_data['selected_package'] = {
@@ -386,7 +619,7 @@ async def handle_topup_selection(update: Update, context: ContextTypes.DEFAULT_T
     if TESTING_MODE:
         token_amount = TEST_TOKEN_AMOUNT
     else:
-        token_amount = calculate_token_amount(marked_up_price_float)
+        token_amount = await calculate_token_amount(marked_up_price_float)
     
     # Make sure to pass the package_id to the payment
     payment = payment_manager.create_payment(
@@ -406,252 +639,269 @@ async def handle_topup_selection(update: Update, context: ContextTypes.DEFAULT_T
     payment_checks[chat_id] = payment.address
     
     # Create payment message showing the marked up price to the user
-    payment_msg = (
-        f"📦 Selected package: {package_id}\n"
-        f"💰 Price: ${marked_up_price_float}\n\n"
-        f"Please send exactly {token_amount} {SPL_TOKEN_SYMBOL} tokens to complete your payment:\n\n"
-        f"`{payment.address}`\n\n"
-        f"⏱️ Payment window: {payment.expires_at.strftime('%H:%M:%S')}\n"
-        f"(You have {payment.time_remaining() // 60:.0f} minutes and {payment.time_remaining() % 60:.0f} seconds to complete payment)"
-    )
+    minutes, seconds = divmod(int(payment.time_remaining()), 60)
+    payment_msg = PAYMENT_MESSAGE_TEMPLATE.format_map({
+        'package_id': package_id,
+        'price': marked_up_price_float,
+        'token_amount': token_amount,
+        'address': payment.address,
+        'expires_at': payment.expires_at.strftime('%H:%M:%S'),
+        'minutes': minutes,
+        'seconds': seconds
+    })
     
-    # Create payment status checking task
-    task = asyncio.create_task(check_payment_status_loop(chat_id, payment.address, context))
-    payment_tasks[payment.address] = task
+    # Schedule background payment status checks
+    schedule_payment_checks(chat_id, payment.address, context)
     
-    keyboard = [[InlineKeyboardButton("🔄 Check Payment Status", callback_data=f"check_payment_{payment.address}")]]
+    keyboard = [[InlineKeyboardButton("🔄 Check Payment Status", callback_data=f"{CHECK_PAYMENT_CALLBACK_PREFIX}{payment.address}")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await query.message.reply_text(payment_msg, reply_markup=reply_markup, parse_mode='Markdown')
 
-async def check_payment_status_loop(chat_id, payment_address, context):
-    """Loop to check payment status periodically."""
-    application = context.application
-    tries = 0
-    max_tries = 30  # 10 minutes with 20-second checks
+async def finalize_paid_order(payment, payment_address, user_data, notify, payment_verb='verified'):
+    """Place the topup order for a completed payment, notify the user and sweep the funds.
+
+    The Airalo order and the Solana sweep are independent, so they run concurrently.
+
+    Args:
+        payment: The completed Payment, or None if it was missing from the result
+        payment_address: The payment address
+        user_data: The user's context data, used as a fallback for the ICCID and package ID
+        notify: Coroutine function that sends a text message to the user
+        payment_verb: How the payment is described in messages ('verified' or 'completed')
+    """
+    order_result, sweep_result = await asyncio.gather(
+        place_topup_order(payment, payment_address, user_data, notify, payment_verb),
+        payment_manager.sweep_funds(payment_address),
+        return_exceptions=True
+    )
     
-    while tries < max_tries:
-        try:
-            result = await payment_manager.check_payment_status(payment_address)
-            
-            if result['success']:
-                # Payment completed
-                payment = result.get('payment')
+    if isinstance(order_result, Exception):
+        logger.error("Error notifying user about payment %s: %s", payment_address, order_result)
+    
+    # Sweep funds to main wallet if not already done
+    if isinstance(sweep_result, Exception):
+        logger.error("Failed to sweep funds for payment %s: %s", payment_address, sweep_result)
+    elif sweep_result['success']:
+        logger.info("Funds swept for payment %s", payment_address)
+        
+        # Check if this needed manual handling due to blockhash errors
+        if sweep_result.get('needs_manual_handling'):
+            logger.warning("Payment %s marked for manual sweeping due to blockhash errors", payment_address)
+    else:
+        error_msg = sweep_result.get('message', 'Unknown error')
+        logger.error("Failed to sweep funds for payment %s: %s", payment_address, error_msg)
+
+async def place_topup_order(payment, payment_address, user_data, notify, payment_verb):
+    """Submit the Airalo topup order for a completed payment and tell the user how it went."""
+    # Check if a topup order has already been placed for this payment
+    if payment and not payment.topup_ordered:
+        # Get the ICCID from the payment object or from user data
+        iccid = payment.iccid
+        
+        # If the payment doesn't have an ICCID, try to get it from user data
+        if not iccid:
+            iccid = user_data.get('iccid')
+        
+        # Get the package ID from the payment or from user data
+        package_id = payment.package_id
+        if not package_id and 'selected_package' in user_data:
+            package_id = user_data['selected_package'].get('id')
+        
+        if iccid and package_id:
+            try:
+                # Submit the order to Airalo
+                description = f"Topup for {iccid} (Payment: {payment_address})"
                 
-                # Check if a topup order has already been placed for this payment
-                if payment and not payment.topup_ordered:
-                    # Get the ICCID from the payment object or from user data
-                    iccid = payment.iccid
-                    
-                    # If the payment doesn't have an ICCID, try to get it from user data
-                    if not iccid:
-                        user_data = context.user_data
-                        iccid = user_data.get('iccid')
-                    
-                    # Get the package ID from the payment or from user data
-                    package_id = payment.package_id
-                    if not package_id and 'selected_package' in context.user_data:
-                        package_id = context.user_data['selected_package'].get('id')
-                    
-                    if iccid and package_id:
-                        try:
-                            # Submit the order to Airalo
-                            description = f"Topup for {iccid} (Payment: {payment_address})"
-                            
-                            logger.info(f"Placing topup order with Airalo: Package {package_id} for ICCID {iccid}")
-                            order_response = await airalo_api.submit_topup_order(package_id, iccid, description)
-                            
-                            if 'data' in order_response and 'id' in order_response['data']:
-                                order_id = order_response['data']['id']
-                                # Mark the payment as having an order placed
-                                payment.topup_ordered = True
-                                payment.topup_order_id = order_id
-                                
-                                logger.info(f"Topup order placed successfully: Order ID {order_id}")
-                                await application.bot.send_message(
-                                    chat_id=chat_id,
-                                    text=f"✅ Payment completed and top-up order placed! Your data package will be activated shortly."
-                                )
-                            else:
-                                logger.error(f"Failed to place topup order: {order_response}")
-                                await application.bot.send_message(
-                                    chat_id=chat_id,
-                                    text="✅ Payment completed! Your top-up is being processed, but we're experiencing some delays. Our team will ensure your package is activated soon."
-                                )
-                        except Exception as e:
-                            logger.error(f"Error placing topup order: {str(e)}")
-                            await application.bot.send_message(
-                                chat_id=chat_id,
-                                text="✅ Payment completed! Your top-up is being processed manually due to a temporary issue. Our team will ensure your package is activated soon."
-                            )
-                    else:
-                        logger.error(f"Missing data for topup order: ICCID={iccid}, Package ID={package_id}")
-                        await application.bot.send_message(
-                            chat_id=chat_id,
-                            text="✅ Payment completed! Your top-up will be processed manually by our team."
-                        )
-                else:
-                    # Payment completed but order already placed or payment object missing
-                    if payment and payment.topup_ordered:
-                        logger.info(f"Topup already ordered for payment {payment_address}")
-                        if payment.topup_order_id:
-                            await application.bot.send_message(
-                                chat_id=chat_id,
-                                text=f"✅ Payment verified! Your top-up order #{payment.topup_order_id} has been placed and is being processed."
-                            )
-                        else:
-                            await application.bot.send_message(
-                                chat_id=chat_id,
-                                text="✅ Payment verified! Your top-up order has been placed and is being processed."
-                            )
-                    else:
-                        logger.warning(f"Payment completed but payment object missing from result")
-                        await application.bot.send_message(
-                            chat_id=chat_id,
-                            text="✅ Payment verified! Your top-up is being processed."
-                        )
+                logger.info("Placing topup order with Airalo: Package %s for ICCID %s", package_id, iccid)
+                order_response = await airalo_api.submit_topup_order(package_id, iccid, description)
                 
-                # Sweep funds to main wallet
-                sweep_result = await payment_manager.sweep_funds(payment_address)
-                if sweep_result['success']:
-                    logger.info(f"Funds swept for payment {payment_address}")
+                if 'data' in order_response and 'id' in order_response['data']:
+                    order_id = order_response['data']['id']
+                    # Mark the payment as having an order placed
+                    payment.topup_ordered = True
+                    payment.topup_order_id = order_id
                     
-                    # Check if this needed manual handling due to blockhash errors
-                    if sweep_result.get('needs_manual_handling'):
-                        logger.warning(f"Payment {payment_address} marked for manual sweeping due to blockhash errors")
+                    logger.info("Topup order placed successfully: Order ID %s", order_id)
+                    await notify(f"✅ Payment {payment_verb} and top-up order placed! Your data package will be activated shortly.")
                 else:
-                    error_msg = sweep_result.get('message', 'Unknown error')
-                    logger.error(f"Failed to sweep funds for payment {payment_address}: {error_msg}")
-                
-                # Clean up
-                if chat_id in payment_checks:
-                    del payment_checks[chat_id]
-                break
-                
-            elif result['status'] == 'expired':
-                # Payment expired
-                await application.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"⏰ Payment window expired. Please try again if you still want to complete your top-up."
-                )
-                
-                # Clean up
-                if chat_id in payment_checks:
-                    del payment_checks[chat_id]
-                break
+                    logger.error("Failed to place topup order: %s", order_response)
+                    await notify(f"✅ Payment {payment_verb}! Your top-up is being processed, but we're experiencing some delays. Our team will ensure your package is activated soon.")
+            except Exception as e:
+                logger.error("Error placing topup order: %s", e)
+                await notify(f"✅ Payment {payment_verb}! Your top-up is being processed manually due to a temporary issue. Our team will ensure your package is activated soon.")
+        else:
+            logger.error("Missing data for topup order: ICCID=%s, Package ID=%s", iccid, package_id)
+            await notify(f"✅ Payment {payment_verb}! Your top-up will be processed manually by our team.")
+    else:
+        # Payment completed but order already placed or payment object missing
+        if payment and payment.topup_ordered:
+            logger.info("Topup already ordered for payment %s", payment_address)
+            if payment.topup_order_id:
+                await notify(f"✅ Payment verified! Your top-up order #{payment.topup_order_id} has been placed and is being processed.")
+            else:
+                await notify("✅ Payment verified! Your top-up order has been placed and is being processed.")
+        else:
+            logger.warning("Payment completed but payment object missing from result")
+            await notify("✅ Payment verified! Your top-up is being processed.")
+
+async def check_payment_status_once(chat_id, payment_address, context, result=None):
+    """Check a payment once, handling it if it has completed or expired.
+
+    The status can be passed in as result when it was already fetched as part of a batch.
+    Returns True when the payment no longer needs to be checked.
+    """
+    application = context.application
+
+    try:
+        if result is None:
+            result = await payment_manager.check_payment_status(payment_address)
+        elif isinstance(result, Exception):
+            raise result
+        
+        if result['success']:
+            # Payment completed
+            async def notify(text):
+                await application.bot.send_message(chat_id=chat_id, text=text)
             
-            # Still waiting
-            tries += 1
-            await asyncio.sleep(20)  # Check every 20 seconds
+            await finalize_paid_order(result.get('payment'), payment_address, context.user_data, notify, 'completed')
             
-        except Exception as e:
-            logger.error(f"Error in payment status loop: {str(e)}")
-            tries += 1
-            await asyncio.sleep(20)
-    
-    # If we get here and haven't broken out of the loop, the payment timed out
-    if tries >= max_tries and chat_id in payment_checks:
-        await application.bot.send_message(
-            chat_id=chat_id,
-            text=f"⏰ Payment checking timed out. Use the Check Payment Status button to verify if your payment went through."
-        )
+            # Clean up
+            if chat_id in payment_checks:
+                del payment_checks[chat_id]
+            return True
+            
+        elif result['status'] == 'expired':
+            # Payment expired
+            await application.bot.send_message(
+                chat_id=chat_id,
+                text=f"⏰ Payment window expired. Please try again if you still want to complete your top-up."
+            )
+            
+            # Clean up
+            if chat_id in payment_checks:
+                del payment_checks[chat_id]
+            return True
+            
+    except Exception as e:
+        logger.error("Error in payment status check: %s", e)
+    
+    # Still waiting
+    return False
+
+def schedule_payment_checks(chat_id, payment_address, context):
+    """Register a new payment with the background payment poller."""
+    # Keep checking until the payment window closes, backing off between checks
+    payment = payment_manager.payments.get(payment_address)
+    if payment:
+        deadline = payment.expires_at.timestamp()
+    else:
+        deadline = time.time() + 10 * 60
+
+    payment_registry.add(
+        payment_address,
+        {
+            'chat_id': chat_id,
+            'context': context,
+            'deadline': deadline,
+            'delay': PAYMENT_POLL_INITIAL_DELAY
+        },
+        time.time() + PAYMENT_POLL_INITIAL_DELAY
+    )
+
+async def poll_payment(payment_address, result=None):
+    """Run one scheduled check for a payment and reschedule it if still pending."""
+    watch = payment_registry.get(payment_address)
+    if watch is None:
+        return
+
+    try:
+        chat_id = watch['chat_id']
+        if await check_payment_status_once(chat_id, payment_address, watch['context'], result):
+            payment_registry.remove(payment_address)
+            return
+
+        remaining = watch['deadline'] - time.time()
+        if remaining <= 0:
+            # The payment timed out
+            payment_registry.remove(payment_address)
+            if chat_id in payment_checks:
+                await watch['context'].application.bot.send_message(
+                    chat_id=chat_id,
+                    text=f"⏰ Payment checking timed out. Use the Check Payment Status button to verify if your payment went through."
+                )
+            return
+
+        # While the watcher is connected it wakes the payment on changes, so polling is only a fallback
+        delay = PAYMENT_POLL_MAX_DELAY if payment_manager.is_watching() else watch['delay']
+        if watch.pop('woken', False):
+            delay = 0
+        payment_registry.reschedule(payment_address, time.time() + min(delay, remaining))
+        watch['delay'] = min(PAYMENT_POLL_MAX_DELAY, watch['delay'] * PAYMENT_POLL_BACKOFF) + random.uniform(0, 1)
+    finally:
+        # A check that failed part way still gets another one
+        payment_registry.requeue([payment_address], time.time() + watch['delay'])
+
+def start_payment_task(coro, name):
+    """Run a per-payment handler in the background, keeping a reference until it finishes."""
+    task = asyncio.create_task(coro, name=name)
+    payment_tasks.add(task)
+    task.add_done_callback(payment_tasks.discard)
+    task.add_done_callback(log_task_exit)
+    return task
+
+async def payment_poller():
+    """Background task that checks all pending payments as they come due."""
+    while True:
+        due = payment_registry.pop_due(time.time(), PAYMENT_POLL_BATCH_SIZE)
+        if not due:
+            # Sleep until the next check is due or a new payment is scheduled
+            await payment_registry.wait_for_due()
+            continue
+
+        started = 0
+        try:
+            # Fetch every due payment's status in one RPC batch, then hand each to its own
+            # task so a slow order or sweep doesn't hold up the other payments' checks
+            statuses = await payment_manager.check_payment_statuses(due)
+            for address, status in zip(due, statuses):
+                start_payment_task(poll_payment(address, status), name=f"poll_payment_{address}")
+                started += 1
+        finally:
+            # Payments whose handler never started go back on the schedule instead of being dropped
+            payment_registry.requeue(due[started:], time.time() + PAYMENT_POLL_INITIAL_DELAY)
+
+async def supervised_payment_poller():
+    """Run the payment poller, restarting it if it ever dies so pending payments keep being checked."""
+    while True:
+        try:
+            await payment_poller()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Payment poller died; restarting in 5 seconds")
+            await asyncio.sleep(5)
+
+def log_task_exit(task):
+    """Done callback that logs a background task ending with an exception."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background task %s exited: %r", task.get_name(), task.exception())
 
 async def handle_payment_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle check payment status button."""
     query = update.callback_query
     await query.answer()
     
-    if not query.data.startswith('check_payment_'):
-        return
-    
-    # Extract payment address
-    payment_address = query.data.split('_')[2]
+    # Extract payment address (everything after the prefix, without splitting)
+    payment_address = query.data[len(CHECK_PAYMENT_CALLBACK_PREFIX):]
     
     # Check payment status
     result = await payment_manager.check_payment_status(payment_address)
     
     if result['success']:
         # Payment completed
-        payment = result.get('payment')
-        
-        # Check if a topup order has already been placed for this payment
-        if payment and not payment.topup_ordered:
-            # Get the ICCID from the payment object or from user data
-            iccid = payment.iccid
-            
-            # If the payment doesn't have an ICCID, try to get it from user data
-            if not iccid:
-                user_data = context.user_data
-                iccid = user_data.get('iccid')
-            
-            # Get the package ID from the payment or from user data
-            package_id = payment.package_id
-            if not package_id and 'selected_package' in context.user_data:
-                package_id = context.user_data['selected_package'].get('id')
-            
-            if iccid and package_id:
-                try:
-                    # Submit the order to Airalo
-                    description = f"Topup for {iccid} (Payment: {payment_address})"
-                    
-                    logger.info(f"Placing topup order with Airalo: Package {package_id} for ICCID {iccid}")
-                    order_response = await airalo_api.submit_topup_order(package_id, iccid, description)
-                    
-                    if 'data' in order_response and 'id' in order_response['data']:
-                        order_id = order_response['data']['id']
-                        # Mark the payment as having an order placed
-                        payment.topup_ordered = True
-                        payment.topup_order_id = order_id
-                        
-                        logger.info(f"Topup order placed successfully: Order ID {order_id}")
-                        await query.message.reply_text(
-                            f"✅ Payment verified and top-up order placed! Your data package will be activated shortly."
-                        )
-                    else:
-                        logger.error(f"Failed to place topup order: {order_response}")
-                        await query.message.reply_text(
-                            "✅ Payment verified! Your top-up is being processed, but we're experiencing some delays. Our team will ensure your package is activated soon."
-                        )
-                except Exception as e:
-                    logger.error(f"Error placing topup order: {str(e)}")
-                    await query.message.reply_text(
-                        "✅ Payment verified! Your top-up is being processed manually due to a temporary issue. Our team will ensure your package is activated soon."
-                    )
-            else:
-                logger.error(f"Missing data for topup order: ICCID={iccid}, Package ID={package_id}")
-                await query.message.reply_text(
-                    "✅ Payment verified! Your top-up will be processed manually by our team."
-                )
-        else:
-            # Payment completed but order already placed or payment object missing
-            if payment and payment.topup_ordered:
-                logger.info(f"Topup already ordered for payment {payment_address}")
-                if payment.topup_order_id:
-                    await query.message.reply_text(
-                        f"✅ Payment verified! Your top-up order #{payment.topup_order_id} has been placed and is being processed."
-                    )
-                else:
-                    await query.message.reply_text(
-                        "✅ Payment verified! Your top-up order has been placed and is being processed."
-                    )
-            else:
-                logger.warning(f"Payment completed but payment object missing from result")
-                await query.message.reply_text(
-                    "✅ Payment verified! Your top-up is being processed."
-                )
-                
-        # Sweep funds to main wallet if not already done
-        sweep_result = await payment_manager.sweep_funds(payment_address)
-        if sweep_result['success']:
-            logger.info(f"Funds swept for payment {payment_address}")
-            
-            # Check if this needed manual handling due to blockhash errors
-            if sweep_result.get('needs_manual_handling'):
-                logger.warning(f"Payment {payment_address} marked for manual sweeping due to blockhash errors")
-        else:
-            error_msg = sweep_result.get('message', 'Unknown error')
-            logger.error(f"Failed to sweep funds for payment {payment_address}: {error_msg}")
-            
+        await finalize_paid_order(result.get('payment'), payment_address, context.user_data, query.message.reply_text)
+    
     elif result['status'] == 'expired':
         # Payment expired
         await query.message.reply_text(
@@ -660,8 +910,7 @@ async def handle_payment_check(update: Update, context: ContextTypes.DEFAULT_TYP
     else:
         # Still waiting
         expires_in = result.get('expires_in', 0)
-        minutes = int(expires_in // 60)
-        seconds = int(expires_in % 60)
+        minutes, seconds = divmod(int(expires_in), 60)
         
         # Retrieve payment amount from result and format message
         payment = result.get('payment')
@@ -672,18 +921,55 @@ async def handle_payment_check(update: Update, context: ContextTypes.DEFAULT_TYP
             f"Time remaining: {minutes} minutes and {seconds} seconds."
         )
 
-async def update_token_price_background():
-    """Background task to periodically update the token price cache."""
-    while True:
-        try:
-            # Fetch new price to update the cache
-            price = get_token_price_usd()
-            logger.info(f"Background token price update: ${price}")
-        except Exception as e:
-            logger.error(f"Error in background token price update: {str(e)}")
-        
-        # Wait before updating again (every 5 minutes)
-        await asyncio.sleep(300)  # 5 minutes
+# Callback data prefixes and their handlers, checked in order (more specific first).
+# Anything unmatched, such as the welcome buttons, goes to handle_service_selection.
+CALLBACK_HANDLERS = (
+    (CHECK_PAYMENT_CALLBACK_PREFIX, handle_payment_check),
+    ('topup_', handle_topup_selection),
+)
+
+async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Route a button press to its handler by callback data prefix."""
+    data = update.callback_query.data or ''
+    for prefix, handler in CALLBACK_HANDLERS:
+        if data.startswith(prefix):
+            return await handler(update, context)
+    return await handle_service_selection(update, context)
+
+async def startup(application):
+    """Warm up the shared clients and start background tasks once the event loop is running."""
+    await get_http_session()
+    
+    # Do the Airalo and Solana RPC TCP+TLS handshakes, fetch the Airalo token,
+    # and prime the token price before the first user request
+    await asyncio.gather(airalo_api.warmup(), payment_manager.warmup(), get_token_price_usd())
+    
+    # Start the background payment checks; the token price refreshes on demand
+    start_background_task(supervised_payment_poller(), name="payment_poller")
+    
+    # Token account changes wake the poller, so idle payments rarely need polling
+    start_background_task(payment_manager.watch(payment_registry.wake), name="payment_watcher")
+
+def start_background_task(coro, name):
+    """Start a long-running task that shutdown() cancels before closing the shared clients."""
+    # PTB doesn't track tasks created before the application has started, so keep them here
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    task.add_done_callback(log_task_exit)
+    return task
+
+async def shutdown(application):
+    """Stop the background tasks and close the shared HTTP sessions after application shutdown."""
+    # Stop everything that uses the shared clients before closing them
+    for tasks in (background_tasks, payment_tasks):
+        for task in list(tasks):
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    await airalo_api.aclose()
+    await payment_manager.aclose()
+    await close_http_session()
 
 def main():
     """Start the bot."""
@@ -696,22 +982,15 @@ def main():
     application.add_handler(CommandHandler("topup", topup))
     application.add_handler(CommandHandler("usage", usage))
     
-    # Add callback handlers in correct order (more specific handlers first)
-    application.add_handler(CallbackQueryHandler(handle_payment_check, pattern="^check_payment_"))
-    application.add_handler(CallbackQueryHandler(handle_topup_selection, pattern="^topup_"))
-    application.add_handler(CallbackQueryHandler(handle_service_selection))
+    # Add a single callback handler that dispatches on the callback data prefix
+    application.add_handler(CallbackQueryHandler(handle_callback_query))
     
     # Add message handlers
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_iccid_input))
 
-    # Set up a pre-run callback to start the background task within the event loop
-    async def post_init(application):
-        """Tasks to run after application startup."""
-        # Start the background task for price updates
-        application.create_task(update_token_price_background())
-    
-    # Register the post_init callback
-    application.post_init = post_init
+    # Register the startup and shutdown callbacks
+    application.post_init = startup
+    application.post_shutdown = shutdown
 
     # Start the Bot
     application.run_polling(allowed_updates=Update.ALL_TYPES)
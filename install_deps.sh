@@ -15,7 +15,7 @@ pip install httpx==0.23.3
 
 # Install base dependencies
 echo "Installing base dependencies..."
-pip install python-dotenv==1.0.1 requests==2.31.0 aiohttp==3.9.3 certifi==2024.2.2 solders==0.19.0 base58==2.1.1
+pip install python-dotenv==1.0.1 requests==2.31.0 aiohttp==3.9.3 certifi==2024.2.2 solders==0.19.0 base58==2.1.1 orjson==3.9.15
 
 # Install solana dependencies
 echo "Installing solana dependencies..."
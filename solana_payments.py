@@ -2,7 +2,13 @@ import os
 import time
 import logging
 import asyncio
-import requests
+import aiohttp
+import orjson
+import heapq
+import random
+import certifi
+import ssl
+import struct
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import base64
@@ -34,6 +40,9 @@ MAIN_WALLET_ADDRESS = os.getenv('SOLANA_MAIN_WALLET')  # Main wallet to sweep fu
 MAIN_WALLET_PRIVATE_KEY = os.getenv('SOLANA_MAIN_WALLET_PRIVATE_KEY')  # Private key for signing
 MAIN_WALLET_TOKEN_ACCOUNT = os.getenv('SOLANA_MAIN_WALLET_TOKEN_ACCOUNT')  # Token account for the SPL token
 SOLANA_NETWORK = os.getenv('SOLANA_NETWORK', 'devnet')  # 'devnet', 'testnet', or 'mainnet-beta'
+SPL_TOKEN_DECIMALS = int(os.getenv('SPL_TOKEN_DECIMALS', '9'))  # Decimals of the SPL token, replaced by the mint's once loaded
+TOKEN_SCALE = 10 ** SPL_TOKEN_DECIMALS  # Raw units per whole token
+RAW_UNITS_THRESHOLD = 10 ** (SPL_TOKEN_DECIMALS - 1)  # Amounts at or above this are assumed to be raw units
 
 # Testing parameters
 TESTING_MODE = os.getenv('TESTING_MODE', 'false').lower() == 'true'  # Reduced token amounts but real tx
@@ -55,6 +64,42 @@ if MOCK_PAYMENT_SUCCESS:
 # It's the program that handles all SPL token operations (creation, transfer, etc.)
 TOKEN_PROGRAM_ID = os.getenv('SPL_TOKEN_PROGRAM_ID', 'TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA')
 
+# Associated Token Account program ID - derives each wallet's default token account for a mint
+ASSOCIATED_TOKEN_PROGRAM_ID = os.getenv('SPL_ASSOCIATED_TOKEN_PROGRAM_ID', 'ATokenGPvbdGVxr1b2hvZbsiqW5xWH25efTNsLJA8knL')
+
+def _parse_pubkey(name, address):
+    """Parse a configured address once at startup, returning None if it is unset or invalid."""
+    if not address:
+        return None
+    try:
+        return Pubkey.from_string(address)
+    except Exception as e:
+        logger.error(f"Invalid {name} address {address}: {str(e)}")
+        return None
+
+# Parsed once so the polling and sweep paths don't re-decode constant addresses
+TOKEN_PROGRAM_PUBKEY = _parse_pubkey('SPL_TOKEN_PROGRAM_ID', TOKEN_PROGRAM_ID)
+SPL_TOKEN_MINT_PUBKEY = _parse_pubkey('SPL_TOKEN_MINT', SPL_TOKEN_MINT)
+MAIN_WALLET_TOKEN_ACCOUNT_PUBKEY = _parse_pubkey('SOLANA_MAIN_WALLET_TOKEN_ACCOUNT', MAIN_WALLET_TOKEN_ACCOUNT)
+ASSOCIATED_TOKEN_PROGRAM_PUBKEY = _parse_pubkey('SPL_ASSOCIATED_TOKEN_PROGRAM_ID', ASSOCIATED_TOKEN_PROGRAM_ID)
+
+def get_associated_token_address(owner_pubkey):
+    """Derive the associated token account of a wallet for SPL_TOKEN_MINT, without an RPC call.
+
+    Returns None if the mint or program addresses are not configured.
+    """
+    if None in (SPL_TOKEN_MINT_PUBKEY, TOKEN_PROGRAM_PUBKEY, ASSOCIATED_TOKEN_PROGRAM_PUBKEY):
+        return None
+    address, _ = Pubkey.find_program_address(
+        [bytes(owner_pubkey), bytes(TOKEN_PROGRAM_PUBKEY), bytes(SPL_TOKEN_MINT_PUBKEY)],
+        ASSOCIATED_TOKEN_PROGRAM_PUBKEY
+    )
+    return address
+
+# SPL token Transfer instruction data: u8 command (3) followed by the amount as a little-endian u64
+SPL_TRANSFER_INSTRUCTION = 3
+_TRANSFER_PACK = struct.Struct('<BQ').pack
+
 # Configure Solana client
 if SOLANA_NETWORK == 'mainnet-beta':
     SOLANA_URL = 'https://api.mainnet-beta.solana.com'
@@ -62,16 +107,90 @@ elif SOLANA_NETWORK == 'testnet':
     SOLANA_URL = 'https://api.testnet.solana.com'
 else:
     SOLANA_URL = 'https://api.devnet.solana.com'
+SOLANA_WS_URL = SOLANA_URL.replace('https://', 'wss://', 1)  # Same node, for account subscriptions
+
+# Payment watcher parameters
+PAYMENT_WATCH_SYNC_INTERVAL = 2  # Seconds between syncing subscriptions with pending payments
+PAYMENT_WATCH_RECONNECT_DELAY = 5  # Seconds to wait before reconnecting the websocket
 
 solana_client = Client(SOLANA_URL)
 
-# Create a direct HTTP client for RPC calls
-def make_rpc_request(method, params=None, retries=3, retry_delay=1):
+# Shared HTTP session for RPC calls, created lazily inside the event loop
+_rpc_session = None
+
+async def get_rpc_session():
+    """Get the shared RPC session, creating it on first use."""
+    global _rpc_session
+    if _rpc_session is None or _rpc_session.closed:
+        # Every RPC call goes to the same node, so keep connections alive between polls
+        connector = aiohttp.TCPConnector(
+            limit=64,
+            keepalive_timeout=75,
+            use_dns_cache=True,
+            ttl_dns_cache=600,
+            ssl=ssl.create_default_context(cafile=certifi.where())
+        )
+        _rpc_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=10),
+            # Request bodies are pre-encoded with orjson, so declare the type once here
+            headers={'Content-Type': 'application/json'}
+        )
+    return _rpc_session
+
+async def close_rpc_session():
+    """Close the shared RPC session."""
+    global _rpc_session
+    if _rpc_session is not None and not _rpc_session.closed:
+        await _rpc_session.close()
+    _rpc_session = None
+
+# Retry and circuit breaker settings for the RPC endpoint
+RPC_RETRY_MAX_DELAY = 30  # Seconds, upper bound for a single backoff sleep
+RPC_CIRCUIT_FAILURE_THRESHOLD = 5  # Consecutive failed attempts before the circuit opens
+RPC_CIRCUIT_COOLDOWN = 30  # Seconds to skip RPC calls once the circuit is open
+
+# Shared by all callers since every request goes to the same SOLANA_URL
+_endpoint_state = {
+    'failures': 0,
+    'open_until': 0.0
+}
+
+def _rpc_circuit_open():
+    """Check whether recent failures have tripped the circuit for the RPC endpoint."""
+    return time.monotonic() < _endpoint_state['open_until']
+
+def _record_rpc_success():
+    """Reset the failure count after the endpoint answers."""
+    _endpoint_state['failures'] = 0
+
+def _record_rpc_failure():
+    """Count a failed attempt and open the circuit once the threshold is reached."""
+    _endpoint_state['failures'] += 1
+    if _endpoint_state['failures'] >= RPC_CIRCUIT_FAILURE_THRESHOLD:
+        _endpoint_state['open_until'] = time.monotonic() + RPC_CIRCUIT_COOLDOWN
+        _endpoint_state['failures'] = 0
+        logger.warning(f"Solana RPC circuit opened for {RPC_CIRCUIT_COOLDOWN} seconds after repeated failures")
+
+def _rpc_retry_delay(retry_delay, attempt, retry_after=None):
+    """Jittered exponential backoff, honouring a Retry-After header when the node sends one."""
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), RPC_RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    return min(retry_delay * 2 ** attempt * random.uniform(0.5, 1.5), RPC_RETRY_MAX_DELAY)
+
+# Make direct JSON-RPC calls over the shared session
+async def make_rpc_request(method, params=None, retries=3, retry_delay=1):
     """Make a direct JSON-RPC request to the Solana node with retries."""
     if params is None:
         params = []
     
-    headers = {"Content-Type": "application/json"}
+    if _rpc_circuit_open():
+        logger.warning(f"Skipping RPC request {method}: circuit is open")
+        return None
+    
     payload = {
         "jsonrpc": "2.0",
         "id": 1,
@@ -79,13 +198,24 @@ def make_rpc_request(method, params=None, retries=3, retry_delay=1):
         "params": params
     }
     
-    logger.debug(f"Making RPC request: {method} with params: {params}")
+    # params can hold a whole serialized transaction, so only format it when DEBUG is on
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Making RPC request: %s with params: %s", method, params)
     
+    body = orjson.dumps(payload)
+    session = await get_rpc_session()
     for attempt in range(retries):
+        retry_after = None
         try:
-            response = requests.post(SOLANA_URL, headers=headers, json=payload, timeout=10)
-            if response.status_code == 200:
-                result = response.json()
+            async with session.post(SOLANA_URL, data=body) as response:
+                status = response.status
+                if status == 200:
+                    result = await response.json(loads=orjson.loads, content_type=None)
+                else:
+                    retry_after = response.headers.get('Retry-After')
+                    response_text = await response.text()
+            if status == 200:
+                _record_rpc_success()
                 if 'error' in result:
                     logger.error(f"RPC error: {result['error']}")
                     # Check if this is a blockhash error - we need special handling
@@ -93,36 +223,156 @@ def make_rpc_request(method, params=None, retries=3, retry_delay=1):
                         logger.warning(f"Blockhash not found error, retrying with new blockhash")
                         if method == "sendTransaction" and attempt < retries - 1:
                             # Sleep a bit longer for blockhash errors
-                            time.sleep(retry_delay * 2)
+                            await asyncio.sleep(_rpc_retry_delay(retry_delay * 2, attempt))
                             continue
                     return result  # Return the error result so caller can handle it
-                logger.debug(f"RPC response received for {method}")
+                logger.debug("RPC response received for %s", method)
                 return result
-            else:
-                logger.error(f"RPC request failed with status {response.status_code}: {response.text}")
-                if attempt < retries - 1:
-                    logger.info(f"Retrying in {retry_delay} seconds... (attempt {attempt+1}/{retries})")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # Exponential backoff
-                continue
+            logger.error(f"RPC request failed with status {status}: {response_text}")
         except Exception as e:
             logger.error(f"Error making RPC request: {str(e)}")
-            if attempt < retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds... (attempt {attempt+1}/{retries})")
-                time.sleep(retry_delay)
-                retry_delay *= 2  # Exponential backoff
-            else:
-                return None
+        
+        _record_rpc_failure()
+        if attempt < retries - 1 and not _rpc_circuit_open():
+            delay = _rpc_retry_delay(retry_delay, attempt, retry_after)
+            logger.info(f"Retrying in {delay:.1f} seconds... (attempt {attempt+1}/{retries})")
+            await asyncio.sleep(delay)
+        else:
+            break
     
     return None
 
+async def make_rpc_batch_request(calls, retries=3, retry_delay=1):
+    """Send several JSON-RPC requests to the Solana node in a single batch POST.
+
+    Args:
+        calls: List of (method, params) tuples
+
+    Returns:
+        List of responses in the same order as calls, with None for any call
+        that got no response
+    """
+    if not calls:
+        return []
+    
+    if _rpc_circuit_open():
+        logger.warning("Skipping RPC batch request: circuit is open")
+        return [None] * len(calls)
+    
+    # Each request's id is its index, so responses can be matched back in any order
+    payload = [
+        {"jsonrpc": "2.0", "id": index, "method": method, "params": params}
+        for index, (method, params) in enumerate(calls)
+    ]
+    
+    logger.debug("Making RPC batch request with %s calls", len(calls))
+    
+    body = orjson.dumps(payload)
+    session = await get_rpc_session()
+    for attempt in range(retries):
+        retry_after = None
+        try:
+            async with session.post(SOLANA_URL, data=body) as response:
+                status = response.status
+                if status == 200:
+                    results = await response.json(loads=orjson.loads, content_type=None)
+                else:
+                    retry_after = response.headers.get('Retry-After')
+                    response_text = await response.text()
+            if status == 200:
+                _record_rpc_success()
+                if isinstance(results, dict):
+                    # The node rejected the batch as a whole; hand the error to every caller
+                    logger.error(f"RPC batch error: {results.get('error')}")
+                    return [results] * len(calls)
+                
+                responses = [None] * len(calls)
+                for result in results:
+                    index = result.get('id')
+                    if isinstance(index, int) and 0 <= index < len(calls):
+                        responses[index] = result
+                return responses
+            else:
+                logger.error(f"RPC batch request failed with status {status}: {response_text}")
+        except Exception as e:
+            logger.error(f"Error making RPC batch request: {str(e)}")
+        
+        _record_rpc_failure()
+        if attempt < retries - 1 and not _rpc_circuit_open():
+            delay = _rpc_retry_delay(retry_delay, attempt, retry_after)
+            logger.info(f"Retrying in {delay:.1f} seconds... (attempt {attempt+1}/{retries})")
+            await asyncio.sleep(delay)
+        else:
+            break
+    
+    return [None] * len(calls)
+
+# Set once the mint's decimals have been read from the chain by load_token_decimals
+_token_decimals_loaded = False
+
+def _set_token_decimals(decimals):
+    """Rebuild the token scale constants for a number of decimals."""
+    global SPL_TOKEN_DECIMALS, TOKEN_SCALE, RAW_UNITS_THRESHOLD
+    SPL_TOKEN_DECIMALS = decimals
+    TOKEN_SCALE = 10 ** decimals
+    RAW_UNITS_THRESHOLD = 10 ** (decimals - 1)
+
+async def load_token_decimals():
+    """Read the mint's decimals from the chain once and use them for the token scale.
+
+    Payment amounts are compared in raw units, so a SPL_TOKEN_DECIMALS that doesn't
+    match the mint would leave exact payments underpaid. Returns True once the
+    on-chain value is in use.
+    """
+    global _token_decimals_loaded
+    if _token_decimals_loaded:
+        return True
+    if SPL_TOKEN_MINT_PUBKEY is None:
+        return False
+    
+    response = await make_rpc_request("getTokenSupply", [str(SPL_TOKEN_MINT_PUBKEY)])
+    try:
+        decimals = int(response['result']['value']['decimals'])
+    except (TypeError, KeyError, ValueError):
+        logger.warning(f"Could not read the decimals of mint {SPL_TOKEN_MINT}: {response}")
+        return False
+    
+    if decimals != SPL_TOKEN_DECIMALS:
+        logger.warning(f"SPL_TOKEN_DECIMALS is {SPL_TOKEN_DECIMALS} but mint {SPL_TOKEN_MINT} has {decimals} decimals, using the mint's value")
+    _set_token_decimals(decimals)
+    _token_decimals_loaded = True
+    return True
+
+def decode_token_amount(account_data):
+    """Decode the raw amount from a base64 dataSlice of an SPL token account.
+
+    Returns None if the data is not the expected 8-byte little-endian u64.
+    """
+    try:
+        amount_bytes = base64.b64decode(account_data[0])
+    except Exception:
+        return None
+    if len(amount_bytes) != 8:
+        return None
+    return int.from_bytes(amount_bytes, 'little')
+
 class Payment:
+    # Fixed attribute set, so many live payments don't each carry an instance dict
+    __slots__ = (
+        'amount', 'user_id', 'package_id', 'keypair', 'pubkey', 'address', 'ata',
+        'created_at', 'expires_at', 'status', 'transaction_signature', 'token_account',
+        'actual_balance', 'previous_balance', 'payment_history',
+        'topup_ordered', 'topup_order_id', 'iccid'
+    )
+
     def __init__(self, amount, user_id=None, package_id=None):
         self.amount = amount
         self.user_id = user_id
         self.package_id = package_id
         self.keypair = Keypair()
-        self.address = str(self.keypair.pubkey())
+        self.pubkey = self.keypair.pubkey()
+        self.address = str(self.pubkey)
+        self.ata = get_associated_token_address(self.pubkey)  # Where the SPL tokens are expected to arrive
         self.created_at = datetime.now()
         self.expires_at = self.created_at + timedelta(minutes=PAYMENT_TIMEOUT_MINUTES)
         self.status = 'pending'  # pending, completed, expired, failed, swept
@@ -130,23 +380,27 @@ class Payment:
         self.token_account = None  # Store the token account address once found
         self.actual_balance = None  # Store the actual token balance for overpayment checking
         self.previous_balance = 0  # Track previous balance for detecting additional payments
-        self.payment_history = []  # Track payment history
+        self.payment_history = []  # (timestamp, previous_balance, new_balance, added_amount) tuples
         self.topup_ordered = False  # Flag to track if topup has been ordered
         self.topup_order_id = None  # Track the Airalo order ID
         self.iccid = None  # Store the ICCID for this payment
         logger.info(f"Created payment address {self.address} for amount {amount} {SPL_TOKEN_SYMBOL}")
 
-    def is_expired(self):
-        """Check if the payment has expired."""
-        return datetime.now() > self.expires_at
+    def is_expired(self, now=None):
+        """Check if the payment has expired, optionally as of a given time."""
+        if now is None:
+            now = datetime.now()
+        return now > self.expires_at
 
-    def time_remaining(self):
-        """Get the remaining time for payment in seconds."""
-        if self.is_expired():
+    def time_remaining(self, now=None):
+        """Get the remaining time for payment in seconds, optionally as of a given time."""
+        if now is None:
+            now = datetime.now()
+        if self.is_expired(now):
             return 0
-        return (self.expires_at - datetime.now()).total_seconds()
+        return (self.expires_at - now).total_seconds()
 
-    def update_balance(self, new_balance):
+    def update_balance(self, new_balance, now=None):
         """Update the payment balance and track payment history."""
         previous = self.actual_balance or 0
         
@@ -154,19 +408,10 @@ class Payment:
         if new_balance > previous:
             added_amount = new_balance - previous
             
-            # Convert to token units for logging if needed
-            token_decimals = int(os.getenv('SPL_TOKEN_DECIMALS', '9'))
-            new_balance_tokens = new_balance / (10 ** token_decimals)
-            previous_tokens = previous / (10 ** token_decimals)
-            added_tokens = added_amount / (10 ** token_decimals)
-            
-            # Record the payment in history
-            self.payment_history.append({
-                'timestamp': datetime.now().isoformat(),
-                'previous_balance': previous,
-                'new_balance': new_balance,
-                'added_amount': added_amount
-            })
+            # Record the payment in history, as a compact tuple with an epoch timestamp
+            self.payment_history.append(
+                ((now or datetime.now()).timestamp(), previous, new_balance, added_amount)
+            )
             
             logger.info(f"Payment {self.address} received {added_amount} tokens (total now: {new_balance})")
             
@@ -198,6 +443,18 @@ class Payment:
                 
         return False
 
+    def payment_history_dicts(self):
+        """Expand the payment history tuples into dictionaries with ISO timestamps."""
+        return [
+            {
+                'timestamp': datetime.fromtimestamp(timestamp).isoformat(),
+                'previous_balance': previous,
+                'new_balance': new_balance,
+                'added_amount': added_amount
+            }
+            for timestamp, previous, new_balance, added_amount in self.payment_history
+        ]
+
     def to_dict(self):
         """Convert payment to dictionary for storage."""
         return {
@@ -212,7 +469,7 @@ class Payment:
             'token_account': self.token_account,
             'actual_balance': self.actual_balance,
             'previous_balance': self.previous_balance,
-            'payment_history': self.payment_history,
+            'payment_history': self.payment_history_dicts(),
             'topup_ordered': self.topup_ordered,
             'topup_order_id': self.topup_order_id,
             'iccid': self.iccid,
@@ -229,6 +486,8 @@ class Payment:
             package_id=data['package_id']
         )
         payment.address = data['address']
+        payment.pubkey = Pubkey.from_string(data['address'])
+        payment.ata = get_associated_token_address(payment.pubkey)
         payment.created_at = datetime.fromisoformat(data['created_at'])
         payment.expires_at = datetime.fromisoformat(data['expires_at'])
         payment.status = data['status']
@@ -236,7 +495,15 @@ class Payment:
         payment.token_account = data.get('token_account')
         payment.actual_balance = data.get('actual_balance')
         payment.previous_balance = data.get('previous_balance')
-        payment.payment_history = data.get('payment_history', [])
+        payment.payment_history = [
+            (
+                datetime.fromisoformat(entry['timestamp']).timestamp(),
+                entry['previous_balance'],
+                entry['new_balance'],
+                entry['added_amount']
+            )
+            for entry in data.get('payment_history', [])
+        ]
         payment.topup_ordered = data.get('topup_ordered', False)
         payment.topup_order_id = data.get('topup_order_id')
         payment.iccid = data.get('iccid')
@@ -252,6 +519,9 @@ class Payment:
 class PaymentManager:
     def __init__(self):
         self.payments = {}  # Dictionary to store payments by address
+        self._pending = set()  # Addresses of payments still awaiting funds
+        self._expiry_heap = []  # (expires_at, address) of pending payments, earliest first
+        self._watching = False  # True while the websocket watcher is connected
         
         if not SPL_TOKEN_MINT:
             logger.warning("SPL_TOKEN_MINT not set in environment variables")
@@ -265,6 +535,115 @@ class PaymentManager:
         logger.info(f"Payment manager initialized for {SOLANA_NETWORK}")
         logger.info(f"Using token: {SPL_TOKEN_SYMBOL} ({SPL_TOKEN_MINT or 'Not Set'})")
 
+    async def warmup(self):
+        """Open a pooled connection to the RPC node and load the mint's decimals ahead of the first payment."""
+        if SPL_TOKEN_MINT and not MOCK_PAYMENT_SUCCESS:
+            # Not fatal; the first payment check loads them instead
+            await load_token_decimals()
+            return
+        
+        # getHealth is the cheapest call the node offers; only the TCP+TLS handshake matters here
+        response = await make_rpc_request("getHealth", retries=1)
+        if response is None:
+            # Not fatal; the first poll will open the connection instead
+            logger.warning("Solana RPC warmup failed")
+
+    def is_watching(self):
+        """Check whether pending payments are currently followed over the websocket."""
+        return self._watching
+
+    async def watch(self, on_update):
+        """Follow pending payments' token accounts over the RPC websocket.
+
+        Each pending payment's associated token account is subscribed with
+        accountSubscribe, so the node pushes changes instead of them being found
+        by polling. on_update(address) is called when a payment's account changes;
+        the balance itself is still checked by check_payment_status. Runs until
+        cancelled, reconnecting after errors.
+        """
+        if MOCK_PAYMENT_SUCCESS or None in (SPL_TOKEN_MINT_PUBKEY, TOKEN_PROGRAM_PUBKEY, ASSOCIATED_TOKEN_PROGRAM_PUBKEY):
+            logger.info("Payment watcher disabled, payments are checked by polling only")
+            return
+        
+        while True:
+            try:
+                await self._watch_connection(on_update)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Payment watcher error: {str(e)}")
+            finally:
+                self._watching = False
+            await asyncio.sleep(PAYMENT_WATCH_RECONNECT_DELAY)
+
+    async def _watch_connection(self, on_update):
+        """Run one websocket connection of the payment watcher until it closes."""
+        subscriptions = {}  # Maps payment address to subscription id
+        subscribed = {}  # Maps subscription id to payment address
+        requested = {}  # Maps request id to payment address awaiting a subscription id
+        request_id = 0
+        
+        session = await get_rpc_session()
+        async with session.ws_connect(SOLANA_WS_URL, heartbeat=30) as ws:
+            self._watching = True
+            logger.info("Payment watcher connected to the Solana RPC websocket")
+            
+            while True:
+                # Subscribe newly pending payments and drop the ones that settled
+                pending = self.pending_addresses()
+                for address in pending.difference(subscriptions, requested.values()):
+                    token_account = self.payments[address].ata
+                    request_id += 1
+                    requested[request_id] = address
+                    await ws.send_str(orjson.dumps({
+                        "jsonrpc": "2.0",
+                        "id": request_id,
+                        "method": "accountSubscribe",
+                        "params": [str(token_account), {"encoding": "base64", "commitment": "confirmed"}]
+                    }).decode())
+                for address in set(subscriptions).difference(pending):
+                    subscription = subscriptions.pop(address)
+                    subscribed.pop(subscription, None)
+                    request_id += 1
+                    await ws.send_str(orjson.dumps({
+                        "jsonrpc": "2.0",
+                        "id": request_id,
+                        "method": "accountUnsubscribe",
+                        "params": [subscription]
+                    }).decode())
+                
+                try:
+                    msg = await ws.receive(timeout=PAYMENT_WATCH_SYNC_INTERVAL)
+                except asyncio.TimeoutError:
+                    continue
+                
+                if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                    logger.warning("Payment watcher websocket closed")
+                    return
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                
+                message = orjson.loads(msg.data)
+                if 'id' in message:
+                    # Reply to a subscribe request; a failed one is retried on the next sync
+                    address = requested.pop(message['id'], None)
+                    if address is None:
+                        continue
+                    if 'result' in message:
+                        subscriptions[address] = message['result']
+                        subscribed[message['result']] = address
+                    else:
+                        logger.error(f"accountSubscribe failed for {address}: {message.get('error')}")
+                elif message.get('method') == 'accountNotification':
+                    address = subscribed.get(message.get('params', {}).get('subscription'))
+                    if address is not None:
+                        logger.debug("Token account of payment %s changed", address)
+                        on_update(address)
+
+    async def aclose(self):
+        """Close the shared RPC session."""
+        await close_rpc_session()
+
     def create_payment(self, amount, user_id=None, package_id=None):
         """Create a new payment and return the address to pay to."""
         # In testing mode, multiply token amount by TESTING_PAYMENT_MULTIPLIER
@@ -275,10 +654,101 @@ class PaymentManager:
         
         payment = Payment(amount, user_id, package_id)
         self.payments[payment.address] = payment
+        self._pending.add(payment.address)
+        heapq.heappush(self._expiry_heap, (payment.expires_at, payment.address))
         return payment
 
-    async def check_payment_status(self, payment_address):
-        """Check if a payment has been received at the given address."""
+    def pending_addresses(self):
+        """Return the addresses of payments still awaiting funds.
+
+        Payments that have settled since the last call are pruned from the index here,
+        so the cost is proportional to the pending payments, not all payments ever made.
+        """
+        settled = [address for address in self._pending if self.payments[address].status != 'pending']
+        self._pending.difference_update(settled)
+        return set(self._pending)
+
+    def expire_stale(self, now=None):
+        """Mark pending payments past their expiry as expired and drop them from the pending index."""
+        if now is None:
+            now = datetime.now()
+        expired_addresses = []
+        while self._expiry_heap and self._expiry_heap[0][0] < now:
+            _, address = heapq.heappop(self._expiry_heap)
+            self._pending.discard(address)
+            payment = self.payments.get(address)
+            if payment and payment.status == 'pending':
+                payment.status = 'expired'
+                expired_addresses.append(address)
+                logger.info(f"Payment {address} expired")
+        return expired_addresses
+
+    def _token_account_params(self, payment_address):
+        """Build the getAccountInfo params for a payment's associated token account."""
+        # The account address is derived when the payment is created, so the node only
+        # has to look up one account instead of scanning everything the owner holds
+        ata = self.payments[payment_address].ata
+        if ata is None:
+            raise ValueError(f"No associated token account for {payment_address}, check SPL_TOKEN_MINT")
+        return [
+            str(ata),
+            # Only fetch the u64 amount at offset 64 of the token account, not the parsed account
+            {"encoding": "base64", "dataSlice": {"offset": 64, "length": 8}, "commitment": "confirmed"}
+        ]
+
+    def _balance_params(self, payment_address):
+        """Build the getBalance params for a payment address."""
+        return [str(self.payments[payment_address].pubkey), {"commitment": "confirmed"}]
+
+    async def check_payment_statuses(self, payment_addresses):
+        """Check several payments, fetching their balances in one JSON-RPC batch.
+
+        Returns a list of check_payment_status results in the same order as
+        payment_addresses. A payment whose batched response is missing falls
+        back to its own RPC requests.
+        """
+        # One timestamp for the whole tick, so every payment is judged against the same "now"
+        now = datetime.now()
+        
+        # Only payments that are still pending need anything from the chain
+        self.expire_stale(now)
+        pending_addresses = self.pending_addresses()
+        pending = [address for address in payment_addresses if address in pending_addresses]
+        
+        prefetched = {}
+        if len(pending) > 1:
+            try:
+                calls = []
+                for address in pending:
+                    if SPL_TOKEN_MINT and not MOCK_PAYMENT_SUCCESS:
+                        calls.append((address, "getAccountInfo", self._token_account_params(address)))
+                    calls.append((address, "getBalance", self._balance_params(address)))
+                
+                responses = await make_rpc_batch_request([(method, params) for _, method, params in calls])
+                for (address, method, _), response in zip(calls, responses):
+                    prefetched.setdefault(address, {})[method] = response
+            except Exception as e:
+                logger.error(f"Error batching payment checks, checking individually: {str(e)}")
+                prefetched = {}
+        
+        return await asyncio.gather(
+            *[self.check_payment_status(address, prefetched.get(address), now) for address in payment_addresses],
+            return_exceptions=True
+        )
+
+    async def check_payment_status(self, payment_address, rpc_responses=None, now=None):
+        """Check if a payment has been received at the given address.
+
+        Args:
+            payment_address: The payment address
+            rpc_responses: Optional responses already fetched by check_payment_statuses,
+                keyed by RPC method name
+            now: Optional time to check against, shared across a polling tick
+        """
+        if rpc_responses is None:
+            rpc_responses = {}
+        if now is None:
+            now = datetime.now()
         try:
             if payment_address not in self.payments:
                 return {'success': False, 'message': 'Payment not found'}
@@ -288,15 +758,16 @@ class PaymentManager:
             if payment.status in ['completed', 'swept']:
                 return {'success': True, 'status': payment.status, 'payment': payment}
             
-            if payment.is_expired():
+            if payment.is_expired(now):
                 payment.status = 'expired'
+                self._pending.discard(payment_address)
                 return {'success': False, 'status': 'expired', 'message': 'Payment expired', 'payment': payment}
             
             # For testing: mock successful payment after a delay 
             # Note that this is different from TESTING_MODE which only reduces token amounts
             if MOCK_PAYMENT_SUCCESS:
                 # Calculate time since payment creation
-                time_since_creation = (datetime.now() - payment.created_at).total_seconds()
+                time_since_creation = (now - payment.created_at).total_seconds()
                 
                 # If enough time has passed, mark payment as completed
                 if time_since_creation >= MOCK_PAYMENT_SUCCESS_DELAY:
@@ -314,132 +785,118 @@ class PaymentManager:
             # Real payment checking with SPL token
             if SPL_TOKEN_MINT and not MOCK_PAYMENT_SUCCESS:
                 try:
-                    # Get token accounts for this address with the specified mint
-                    # Convert string address to Pubkey object
-                    payment_pubkey = Pubkey.from_string(payment_address)
-                    mint_pubkey = Pubkey.from_string(SPL_TOKEN_MINT)
+                    # Balances are compared in raw units, which needs the mint's real decimals
+                    if not await load_token_decimals():
+                        raise ValueError(f"Decimals of mint {SPL_TOKEN_MINT} are not loaded yet")
                     
-                    logger.info(f"Checking token accounts for address {payment_address} with mint {SPL_TOKEN_MINT}")
+                    # Look up the payment's associated token account for the mint
+                    logger.info(f"Checking token account {payment.ata} of address {payment_address}")
                     
-                    # Make a direct RPC call to get token accounts
-                    params = [
-                        str(payment_pubkey),
-                        {"mint": str(mint_pubkey)},
-                        {"encoding": "jsonParsed", "commitment": "confirmed"}
-                    ]
-                    
-                    response_data = make_rpc_request("getTokenAccountsByOwner", params)
+                    # Make a direct RPC call to get the token account unless it was batched
+                    response_data = rpc_responses.get("getAccountInfo")
+                    if response_data is None:
+                        params = self._token_account_params(payment_address)
+                        response_data = await make_rpc_request("getAccountInfo", params)
                     
                     if response_data and 'result' in response_data and 'value' in response_data['result']:
-                        token_accounts = response_data['result']['value']
-                        logger.info(f"Found {len(token_accounts)} token accounts via direct RPC")
-                        
-                        for account in token_accounts:
-                            token_account_address = account['pubkey']
-                            account_data = account['account']['data']
+                        # The value is None until the associated token account has been created
+                        account = response_data['result']['value']
+                        if account is not None:
+                            token_account_address = str(payment.ata)
+                            account_data = account['data']
                             
-                            # For jsonParsed encoding, the parsed data is in the parsed field
-                            if 'parsed' in account_data:
-                                parsed_data = account_data['parsed']
-                                if 'info' in parsed_data and 'tokenAmount' in parsed_data['info']:
-                                    token_amount = parsed_data['info']['tokenAmount']
-                                    token_balance = int(token_amount['amount'])
-                                    
-                                    # Get token decimals from response or environment
-                                    token_decimals = int(token_amount.get('decimals', os.getenv('SPL_TOKEN_DECIMALS', '9')))
-                                    
-                                    # Convert to human-readable amount for logging
-                                    display_balance = token_balance / (10 ** token_decimals)
-                                    logger.info(f"Found token account {token_account_address} with balance {token_balance} raw units ({display_balance} tokens)")
+                            # The data is only the base64 u64 amount (see _token_account_params)
+                            token_balance = decode_token_amount(account_data)
+                            if token_balance is not None:
+                                # Convert to human-readable amount for logging
+                                display_balance = token_balance / TOKEN_SCALE
+                                logger.info(f"Found token account {token_account_address} with balance {token_balance} raw units ({display_balance} tokens)")
+                                
+                                # Store the account address for later use in sweeping
+                                payment.token_account = token_account_address
+                                
+                                # Check what unit the payment amount is in
+                                # If payment.amount is small (like 1) but token_balance is large (like 1000000),
+                                # then payment.amount is likely in tokens, not raw units
+                                if payment.amount < 1000 and token_balance > 1000:
+                                    # Convert payment amount to raw units for comparison
+                                    payment_amount_raw = payment.amount * TOKEN_SCALE
+                                    logger.info(f"Converting payment amount {payment.amount} to raw units: {payment_amount_raw}")
                                     
-                                    # Store the account address for later use in sweeping
-                                    payment.token_account = token_account_address
-                                    
-                                    # Check what unit the payment amount is in
-                                    # If payment.amount is small (like 1) but token_balance is large (like 1000000),
-                                    # then payment.amount is likely in tokens, not raw units
-                                    if payment.amount < 1000 and token_balance > 1000:
-                                        # Convert payment amount to raw units for comparison
-                                        payment_amount_raw = payment.amount * (10 ** token_decimals)
-                                        logger.info(f"Converting payment amount {payment.amount} to raw units: {payment_amount_raw}")
+                                    # Check if payment is complete based on raw units
+                                    if token_balance >= payment_amount_raw:
+                                        payment.status = 'completed'
+                                        if not payment.transaction_signature:
+                                            payment.transaction_signature = f"token_transfer_{int(time.time())}"
                                         
-                                        # Check if payment is complete based on raw units
-                                        if token_balance >= payment_amount_raw:
-                                            payment.status = 'completed'
-                                            if not payment.transaction_signature:
-                                                payment.transaction_signature = f"token_transfer_{int(time.time())}"
-                                            
-                                            # Store the actual balance
-                                            payment.actual_balance = token_balance
-                                            
-                                            # Check for overpayment
-                                            if token_balance > payment_amount_raw:
-                                                overpayment = token_balance - payment_amount_raw
-                                                overpayment_display = overpayment / (10 ** token_decimals)
-                                                logger.info(f"Overpayment detected: {overpayment} raw units ({overpayment_display} tokens)")
-                                            
-                                            logger.info(f"Payment completed: {payment_address} with balance {token_balance} raw units ({display_balance} tokens)")
-                                            return {'success': True, 'status': 'completed', 'payment': payment}
-                                        else:
-                                            # Underpayment in raw units
-                                            underpayment = payment_amount_raw - token_balance
-                                            underpayment_display = underpayment / (10 ** token_decimals)
-                                            
-                                            logger.info(f"Underpayment detected: {payment_address} has {token_balance} raw units, needs {underpayment} more")
-                                            
-                                            # Update payment record with current balance
-                                            payment.update_balance(token_balance)
-                                            
-                                            return {
-                                                'success': False, 
-                                                'status': 'underpaid', 
-                                                'message': f'Underpaid by {underpayment_display} tokens', 
-                                                'payment': payment,
-                                                'amount_paid': display_balance,
-                                                'amount_remaining': underpayment_display,
-                                                'payment_history': payment.payment_history
-                                            }
+                                        # Store the actual balance
+                                        payment.actual_balance = token_balance
+                                        
+                                        # Check for overpayment
+                                        if token_balance > payment_amount_raw:
+                                            overpayment = token_balance - payment_amount_raw
+                                            overpayment_display = overpayment / TOKEN_SCALE
+                                            logger.info(f"Overpayment detected: {overpayment} raw units ({overpayment_display} tokens)")
+                                        
+                                        logger.info(f"Payment completed: {payment_address} with balance {token_balance} raw units ({display_balance} tokens)")
+                                        return {'success': True, 'status': 'completed', 'payment': payment}
                                     else:
-                                        # Normal case - direct comparison
-                                        # Update balance and track payment history
-                                        payment_completed = payment.update_balance(token_balance)
+                                        # Underpayment in raw units
+                                        underpayment = payment_amount_raw - token_balance
+                                        underpayment_display = underpayment / TOKEN_SCALE
                                         
-                                        # If payment is now complete
-                                        if payment_completed or payment.status == 'completed':
-                                            # Create a transaction signature if one doesn't exist
-                                            if not payment.transaction_signature:
-                                                payment.transaction_signature = f"token_transfer_{int(time.time())}"
-                                                
-                                            logger.info(f"Payment completed: {payment_address} with balance {token_balance}")
-                                            return {'success': True, 'status': 'completed', 'payment': payment}
-                                        else:
-                                            # Handle underpayment - we found a balance but it's not enough
-                                            underpayment = payment.amount - token_balance
-                                            logger.info(f"Underpayment detected: {payment_address} has {token_balance} tokens, needs {underpayment} more")
+                                        logger.info(f"Underpayment detected: {payment_address} has {token_balance} raw units, needs {underpayment} more")
+                                        
+                                        # Update payment record with current balance
+                                        payment.update_balance(token_balance, now)
+                                        
+                                        return {
+                                            'success': False, 
+                                            'status': 'underpaid', 
+                                            'message': f'Underpaid by {underpayment_display} tokens', 
+                                            'payment': payment,
+                                            'amount_paid': display_balance,
+                                            'amount_remaining': underpayment_display,
+                                            'payment_history': payment.payment_history_dicts()
+                                        }
+                                else:
+                                    # Normal case - direct comparison
+                                    # Update balance and track payment history
+                                    payment_completed = payment.update_balance(token_balance, now)
+                                    
+                                    # If payment is now complete
+                                    if payment_completed or payment.status == 'completed':
+                                        # Create a transaction signature if one doesn't exist
+                                        if not payment.transaction_signature:
+                                            payment.transaction_signature = f"token_transfer_{int(time.time())}"
                                             
-                                            return {
-                                                'success': False, 
-                                                'status': 'underpaid', 
-                                                'message': f'Underpaid by {underpayment} tokens', 
-                                                'payment': payment,
-                                                'amount_paid': token_balance,
-                                                'amount_remaining': underpayment,
-                                                'payment_history': payment.payment_history
-                                            }
+                                        logger.info(f"Payment completed: {payment_address} with balance {token_balance}")
+                                        return {'success': True, 'status': 'completed', 'payment': payment}
+                                    else:
+                                        # Handle underpayment - we found a balance but it's not enough
+                                        underpayment = payment.amount - token_balance
+                                        logger.info(f"Underpayment detected: {payment_address} has {token_balance} tokens, needs {underpayment} more")
+                                        
+                                        return {
+                                            'success': False, 
+                                            'status': 'underpaid', 
+                                            'message': f'Underpaid by {underpayment} tokens', 
+                                            'payment': payment,
+                                            'amount_paid': token_balance,
+                                            'amount_remaining': underpayment,
+                                            'payment_history': payment.payment_history_dicts()
+                                        }
                 except Exception as e:
                     logger.error(f"Error checking token balance: {str(e)}")
-                    import traceback
-                    logger.error(f"Token check error traceback: {traceback.format_exc()}")
+                    logger.debug("Token check error traceback", exc_info=True)
             
             # Fallback to checking regular SOL balance for testing
             try:
-                # Convert string address to Pubkey object
-                payment_pubkey = Pubkey.from_string(payment_address)
-                
-                # Use direct RPC call for consistency
-                params = [str(payment_pubkey), {"commitment": "confirmed"}]
-                
-                response_data = make_rpc_request("getBalance", params)
+                # Use direct RPC call for consistency, unless it was batched
+                response_data = rpc_responses.get("getBalance")
+                if response_data is None:
+                    params = self._balance_params(payment_address)
+                    response_data = await make_rpc_request("getBalance", params)
                 
                 if response_data and 'result' in response_data and 'value' in response_data['result']:
                     balance = response_data['result']['value']
@@ -453,15 +910,14 @@ class PaymentManager:
                         return {'success': True, 'status': 'completed', 'payment': payment}
             except Exception as e:
                 logger.error(f"Error checking SOL balance: {str(e)}")
-                import traceback
-                logger.error(f"SOL check error traceback: {traceback.format_exc()}")
+                logger.debug("SOL check error traceback", exc_info=True)
             
             # If we get here, payment is still pending
             return {
                 'success': False, 
                 'status': 'pending', 
                 'message': 'Payment pending', 
-                'expires_in': payment.time_remaining(),
+                'expires_in': payment.time_remaining(now),
                 'payment': payment
             }
         
@@ -472,25 +928,22 @@ class PaymentManager:
     # Helper function to create SPL token transfer instruction
     def _create_token_transfer_instruction(self, source, destination, owner, amount):
         """Create a token transfer instruction for SPL tokens."""
-        token_program_id = Pubkey.from_string(TOKEN_PROGRAM_ID)
+        token_program_id = TOKEN_PROGRAM_PUBKEY
         source_pubkey = Pubkey.from_string(source)
         destination_pubkey = Pubkey.from_string(destination)
         owner_pubkey = Pubkey.from_string(owner)
         
-        # Get the token decimals from env
-        token_decimals = int(os.getenv('SPL_TOKEN_DECIMALS', '9'))
-        
         # Check if amount is already in raw units (when it's over 10^(decimals-1) for a token)
-        is_raw_units = amount >= (10 ** (token_decimals - 1))
+        is_raw_units = amount >= RAW_UNITS_THRESHOLD
         
         # Calculate display amount and raw amount
         if is_raw_units:
-            display_amount = amount / (10 ** token_decimals)
+            display_amount = amount / TOKEN_SCALE
             actual_amount = amount  # Already in raw units
             logger.info(f"Amount {amount} is in raw units (equals {display_amount} tokens)")
         else:
             display_amount = amount
-            actual_amount = amount * (10 ** token_decimals)
+            actual_amount = amount * TOKEN_SCALE
             logger.info(f"Converting {display_amount} tokens to {actual_amount} raw units")
         
         logger.info(f"Creating token transfer instruction for {display_amount} tokens ({actual_amount} raw units)")
@@ -503,7 +956,7 @@ class PaymentManager:
         ]
         
         # Token transfer command is 3, followed by the amount as a u64
-        data = bytes([3]) + actual_amount.to_bytes(8, 'little')
+        data = _TRANSFER_PACK(SPL_TRANSFER_INSTRUCTION, actual_amount)
         
         return Instruction(
             program_id=token_program_id,
@@ -536,6 +989,9 @@ class PaymentManager:
             if not MAIN_WALLET_TOKEN_ACCOUNT:
                 return {'success': False, 'message': 'Main wallet token account not configured'}
             
+            if MAIN_WALLET_TOKEN_ACCOUNT_PUBKEY is None:
+                return {'success': False, 'message': 'Main wallet token account address is invalid'}
+            
             if not payment.token_account:
                 return {'success': False, 'message': 'No token account found for payment address'}
                 
@@ -638,9 +1094,6 @@ class PaymentManager:
                 if actual_token_balance <= 0:
                     return {'success': False, 'message': 'No tokens found in account to sweep'}
                 
-                # Get token decimals from environment
-                token_decimals = int(os.getenv('SPL_TOKEN_DECIMALS', '6'))
-                
                 # Create the transaction
                 tx = Transaction(
                     fee_payer=main_wallet_keypair.pubkey(),
@@ -648,13 +1101,13 @@ class PaymentManager:
                 )
                 
                 # Create and add the token transfer instruction
-                token_program_id = Pubkey.from_string(TOKEN_PROGRAM_ID)
+                token_program_id = TOKEN_PROGRAM_PUBKEY
                 source_pubkey = Pubkey.from_string(payment.token_account)
-                destination_pubkey = Pubkey.from_string(MAIN_WALLET_TOKEN_ACCOUNT)
-                owner_pubkey = Pubkey.from_string(payment_address)
+                destination_pubkey = MAIN_WALLET_TOKEN_ACCOUNT_PUBKEY
+                owner_pubkey = payment.pubkey
                 
                 # Token transfer command is 3 (transfer), followed by the amount as a u64
-                data = bytes([3]) + actual_token_balance.to_bytes(8, 'little')
+                data = _TRANSFER_PACK(SPL_TRANSFER_INSTRUCTION, actual_token_balance)
                 
                 # Create proper account metas
                 keys = [
@@ -696,7 +1149,7 @@ class PaymentManager:
                 
                 send_params = [serialized_tx_base64, tx_options]
                 
-                signature_response = make_rpc_request("sendTransaction", send_params)
+                signature_response = await make_rpc_request("sendTransaction", send_params)
                 
                 if signature_response and 'result' in signature_response:
                     txn_signature = signature_response['result']
@@ -707,7 +1160,7 @@ class PaymentManager:
                     payment.transaction_signature = txn_signature
                     
                     # Calculate display amount
-                    display_amount = actual_token_balance / (10 ** token_decimals)
+                    display_amount = actual_token_balance / TOKEN_SCALE
                     
                     return {
                         'success': True,
@@ -766,14 +1219,12 @@ class PaymentManager:
                 
             except Exception as e:
                 logger.error(f"Error creating sweep transaction: {str(e)}")
-                import traceback
-                logger.error(f"Sweep error traceback: {traceback.format_exc()}")
+                logger.debug("Sweep error traceback", exc_info=True)
                 return {'success': False, 'message': f'Error creating sweep transaction: {str(e)}'}
                 
         except Exception as e:
             logger.error(f"Error sweeping funds: {str(e)}")
-            import traceback
-            logger.error(f"Sweep error traceback: {traceback.format_exc()}")
+            logger.debug("Sweep error traceback", exc_info=True)
             return {'success': False, 'message': f"Error sweeping funds: {str(e)}"}
 
     async def sweep_and_confirm(self, payment_address, max_confirmations=10, confirmation_interval=2):
@@ -809,7 +1260,7 @@ class PaymentManager:
                 logger.info(f"Checking transaction status (attempt {attempt+1}/{max_confirmations})...")
                 
                 # Check transaction status
-                status_response = make_rpc_request("getSignatureStatuses", [[txn_signature]])
+                status_response = await make_rpc_request("getSignatureStatuses", [[txn_signature]])
                 
                 if status_response and 'result' in status_response and 'value' in status_response['result']:
                     statuses = status_response['result']['value']
@@ -863,16 +1314,9 @@ class PaymentManager:
 
     async def cleanup_expired_payments(self):
         """Check for and remove expired payments."""
-        expired_addresses = []
-        for address, payment in self.payments.items():
-            if payment.is_expired() and payment.status == 'pending':
-                payment.status = 'expired'
-                expired_addresses.append(address)
-                logger.info(f"Payment {address} expired")
-        
-        # You might want to keep expired payments for record-keeping
-        # or remove them to save memory
-        return expired_addresses
+        # Expired payments stay in self.payments for record-keeping, but leave the
+        # pending index so polling no longer touches them
+        return self.expire_stale()
         
     async def check_transaction_status(self, signature):
         """Check the status of a transaction on the Solana blockchain."""
@@ -886,7 +1330,7 @@ class PaymentManager:
             
             # Try checking transaction status first - this is more efficient
             params = [signature, {"commitment": "confirmed"}]
-            status_response = make_rpc_request("getSignatureStatuses", [params])
+            status_response = await make_rpc_request("getSignatureStatuses", [params])
             
             if status_response and 'result' in status_response and 'value' in status_response['result']:
                 statuses = status_response['result']['value']
@@ -912,7 +1356,7 @@ class PaymentManager:
             
             # Use getTransaction as a fallback or for more detailed information
             params = [signature, {"commitment": "confirmed"}]
-            response_data = make_rpc_request("getTransaction", params)
+            response_data = await make_rpc_request("getTransaction", params)
             
             # Check for RPC errors related to invalid parameters
             if response_data and 'error' in response_data:
@@ -967,7 +1411,7 @@ class PaymentManager:
             
             # Make RPC call to get account info
             params = [token_account_pubkey, {"encoding": "jsonParsed", "commitment": "confirmed"}]
-            response_data = make_rpc_request("getAccountInfo", params)
+            response_data = await make_rpc_request("getAccountInfo", params)
             
             # Check if account exists
             if response_data and 'result' in response_data:
@@ -998,7 +1442,7 @@ class PaymentManager:
         try:
             # Make RPC call to get account info with jsonParsed encoding
             params = [token_account_address, {"encoding": "jsonParsed", "commitment": "confirmed"}]
-            response_data = make_rpc_request("getAccountInfo", params)
+            response_data = await make_rpc_request("getAccountInfo", params)
             
             if response_data and 'result' in response_data and 'value' in response_data['result']:
                 result = response_data['result']['value']
@@ -1037,17 +1481,15 @@ class PaymentManager:
         Returns:
             The converted amount
         """
-        token_decimals = int(os.getenv('SPL_TOKEN_DECIMALS', '9'))
-        
         if to_raw:
             # Check if already in raw units (large number)
-            if amount >= 10 ** (token_decimals - 1):  # Assume already raw if >= 10^(decimals-1)
+            if amount >= RAW_UNITS_THRESHOLD:  # Assume already raw if >= 10^(decimals-1)
                 return amount
             else:
-                return amount * (10 ** token_decimals)
+                return amount * TOKEN_SCALE
         else:
             # Convert from raw to token units
-            return amount / (10 ** token_decimals)
+            return amount / TOKEN_SCALE
             
     def _is_raw_units(self, amount):
         """
@@ -1059,15 +1501,14 @@ class PaymentManager:
         Returns:
             True if the amount appears to be in raw units, False otherwise
         """
-        token_decimals = int(os.getenv('SPL_TOKEN_DECIMALS', '9'))
-        return amount >= 10 ** (token_decimals - 1)
+        return amount >= RAW_UNITS_THRESHOLD
 
     async def verify_token_account_data(self, token_account_address):
         """Verify that a token account is valid and has correct data structure for transfers."""
         try:
             # Make RPC call to get account info with jsonParsed encoding
             params = [token_account_address, {"encoding": "jsonParsed", "commitment": "confirmed"}]
-            response_data = make_rpc_request("getAccountInfo", params)
+            response_data = await make_rpc_request("getAccountInfo", params)
             
             if response_data and 'result' in response_data and 'value' in response_data['result']:
                 result = response_data['result']['value']
@@ -1185,7 +1626,7 @@ class PaymentManager:
                 return {'success': False, 'message': f'Error parsing private key: {str(e)}'}
             
             # Get recent blockhash
-            blockhash_resp = make_rpc_request("getLatestBlockhash", [{"commitment": "finalized"}])
+            blockhash_resp = await make_rpc_request("getLatestBlockhash", [{"commitment": "finalized"}])
             if not blockhash_resp or 'result' not in blockhash_resp or 'value' not in blockhash_resp['result']:
                 return {'success': False, 'message': 'Failed to get blockhash for ATA creation'}
             
@@ -1248,7 +1689,7 @@ class PaymentManager:
                 {"encoding": "jsonParsed", "commitment": "confirmed"}
             ]
             
-            response_data = make_rpc_request("getTokenAccountsByOwner", params)
+            response_data = await make_rpc_request("getTokenAccountsByOwner", params)
             
             if response_data and 'result' in response_data and 'value' in response_data['result']:
                 token_accounts = response_data['result']['value']
@@ -1301,7 +1742,7 @@ class PaymentManager:
         try:
             # Make RPC call to get account info with jsonParsed encoding
             params = [token_account_address, {"encoding": "jsonParsed", "commitment": "confirmed"}]
-            response_data = make_rpc_request("getAccountInfo", params)
+            response_data = await make_rpc_request("getAccountInfo", params)
             
             if response_data and 'result' in response_data and 'value' in response_data['result']:
                 result = response_data['result']['value']
@@ -1353,7 +1794,7 @@ class PaymentManager:
         for attempt in range(retries):
             try:
                 # Get the latest blockhash
-                blockhash_resp = make_rpc_request("getLatestBlockhash", [{"commitment": commitment}])
+                blockhash_resp = await make_rpc_request("getLatestBlockhash", [{"commitment": commitment}])
                 if blockhash_resp and 'result' in blockhash_resp and 'value' in blockhash_resp['result']:
                     blockhash = blockhash_resp['result']['value']['blockhash']
                     logger.info(f"Got blockhash: {blockhash} (attempt {attempt+1})")
@@ -1361,7 +1802,7 @@ class PaymentManager:
                     # Verify the blockhash is valid by testing it
                     # The isBlockhashValid method expects the blockhash as a string, not a map
                     verify_params = [blockhash]
-                    verify_resp = make_rpc_request("isBlockhashValid", verify_params)
+                    verify_resp = await make_rpc_request("isBlockhashValid", verify_params)
                     
                     if verify_resp and 'result' in verify_resp and 'value' in verify_resp['result']:
                         is_valid = verify_resp['result']['value']
@@ -1395,7 +1836,7 @@ class PaymentManager:
                 commitment = "processed"
             
             # Get the latest blockhash with specified commitment level
-            blockhash_resp = make_rpc_request("getLatestBlockhash", [{"commitment": commitment}])
+            blockhash_resp = await make_rpc_request("getLatestBlockhash", [{"commitment": commitment}])
             if blockhash_resp and 'result' in blockhash_resp and 'value' in blockhash_resp['result']:
                 blockhash = blockhash_resp['result']['value']['blockhash']
                 logger.info(f"Got blockhash with {commitment} commitment: {blockhash}")
@@ -1407,7 +1848,7 @@ class PaymentManager:
                     logger.info(f"Blockhash valid until block height: {last_valid}")
                     
                     # Get current block height
-                    current_block_resp = make_rpc_request("getBlockHeight", [{"commitment": commitment}])
+                    current_block_resp = await make_rpc_request("getBlockHeight", [{"commitment": commitment}])
                     if current_block_resp and 'result' in current_block_resp:
                         current_height = current_block_resp['result']
                         logger.info(f"Current block height: {current_height}")
@@ -0,0 +1,110 @@
+import os
+import time
+import asyncio
+import logging
+
+# Set environment variables for testing before importing the bot
+os.environ['TESTING_MODE'] = 'true'
+os.environ['MOCK_PAYMENT_SUCCESS'] = 'false'
+os.environ['SPL_TOKEN_SYMBOL'] = 'TEST'
+os.environ.setdefault('AIRALO_CLIENT_ID', 'test_client_id')  # The bot builds its Airalo client at import
+os.environ.setdefault('AIRALO_CLIENT_SECRET', 'test_client_secret')
+
+# Import after setting environment variables
+from bot import PaymentRegistry
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def test_pop_due_order_and_limit():
+    """Test that due payments come out earliest first, up to the limit."""
+    registry = PaymentRegistry()
+    registry.add('b', {}, 20)
+    registry.add('a', {}, 10)
+    registry.add('c', {}, 30)
+    registry.add('d', {}, 100)
+
+    assert registry.pop_due(5, 10) == [], "Nothing should be due yet"
+    assert registry.pop_due(40, 2) == ['a', 'b'], "Should pop the two earliest due payments"
+    assert registry.pop_due(40, 10) == ['c'], "Should pop the remaining due payment"
+    assert registry.pop_due(200, 10) == ['d']
+    assert registry.pop_due(200, 10) == [], "Popped payments should not come out twice"
+
+def test_reschedule_and_remove():
+    """Test that a reschedule replaces the earlier check and removed payments are skipped."""
+    registry = PaymentRegistry()
+    registry.add('a', {}, 10)
+    registry.reschedule('a', 50)
+    registry.add('b', {}, 10)
+    registry.remove('b')
+
+    assert registry.pop_due(20, 10) == [], "The superseded check and the removed payment should be skipped"
+    assert registry.pop_due(60, 10) == ['a']
+    assert registry.get('b') is None
+
+def test_requeue():
+    """Test that only popped payments which were neither rescheduled nor removed are requeued."""
+    registry = PaymentRegistry()
+    for address in ('a', 'b', 'c'):
+        registry.add(address, {}, 10)
+    assert registry.pop_due(10, 10) == ['a', 'b', 'c']
+
+    # 'b' was rescheduled by its check and 'c' was finished, so only 'a' goes back
+    registry.reschedule('b', 30)
+    registry.remove('c')
+    registry.requeue(['a', 'b', 'c'], 20)
+
+    assert registry.pop_due(25, 10) == ['a']
+    assert registry.pop_due(35, 10) == ['b'], "The requeue should not replace the reschedule"
+    assert registry.pop_due(100, 10) == []
+
+def test_wake():
+    """Test that a wake moves a scheduled check forward and is remembered during a check."""
+    registry = PaymentRegistry()
+    registry.add('a', {}, time.time() + 60)
+    registry.wake('a')
+    assert registry.pop_due(time.time(), 10) == ['a'], "A woken payment should be due right away"
+
+    # While 'a' is being checked a wake only flags it, so it isn't checked twice at once
+    registry.wake('a')
+    assert registry.pop_due(time.time(), 10) == []
+    assert registry.get('a')['woken'] is True
+
+    # Waking an untracked payment is a no-op
+    registry.wake('unknown')
+    assert registry.get('unknown') is None
+
+def test_wait_for_due():
+    """Test that the poller wakes for the next due check and for newly added payments."""
+    async def run():
+        registry = PaymentRegistry()
+
+        # Wakes when the earliest check comes due
+        registry.add('a', {}, time.time() + 0.05)
+        started = time.monotonic()
+        await asyncio.wait_for(registry.wait_for_due(), 1)
+        assert time.monotonic() - started >= 0.04, "Should sleep until the check is due"
+        assert registry.pop_due(time.time(), 10) == ['a']
+
+        # Wakes early when a payment is added while waiting for a distant check
+        registry.add('b', {}, time.time() + 60)
+        waiter = asyncio.create_task(registry.wait_for_due())
+        await asyncio.sleep(0)
+        registry.add('c', {}, time.time())
+        await asyncio.wait_for(waiter, 1)
+        assert registry.pop_due(time.time(), 10) == ['c']
+
+    asyncio.run(run())
+
+def main():
+    logger.info("Starting payment registry tests...")
+    test_pop_due_order_and_limit()
+    test_reschedule_and_remove()
+    test_requeue()
+    test_wake()
+    test_wait_for_due()
+    logger.info("All payment registry tests passed.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import os
+import asyncio
+import base64
+import contextlib
+import logging
+import time
+from solders.keypair import Keypair
+
+# Set environment variables for testing
+os.environ['TESTING_MODE'] = 'true'
+os.environ['MOCK_PAYMENT_SUCCESS'] = 'false'
+os.environ['SPL_TOKEN_DECIMALS'] = '6'
+os.environ['SPL_TOKEN_MINT'] = str(Keypair().pubkey())
+os.environ['SPL_TOKEN_SYMBOL'] = 'TEST'
+
+# Import after setting environment variables
+import solana_payments
+from solana_payments import decode_token_amount
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def encode_amount(amount):
+    """Build the base64 dataSlice the node returns for a token account's amount."""
+    return [base64.b64encode(amount.to_bytes(8, 'little')).decode('ascii'), 'base64']
+
+def test_decode_token_amount():
+    """Test decoding the u64 amount from a base64 dataSlice."""
+    assert decode_token_amount(encode_amount(0)) == 0
+    assert decode_token_amount(encode_amount(1_500_000)) == 1_500_000
+    assert decode_token_amount(encode_amount(2 ** 64 - 1)) == 2 ** 64 - 1
+
+def test_decode_token_amount_malformed():
+    """Test that malformed account data decodes to None instead of raising."""
+    short = [base64.b64encode(b'\x01\x02\x03\x04').decode('ascii'), 'base64']
+    long = [base64.b64encode(bytes(165)).decode('ascii'), 'base64']
+    for account_data in (short, long, ['not base64!', 'base64'], [], None, [None, 'base64']):
+        assert decode_token_amount(account_data) is None, f"{account_data!r} should not decode"
+
+class FakeResponse:
+    """Stand-in for an aiohttp response from the RPC node."""
+    def __init__(self, status, payload, headers=None):
+        self.status = status
+        self.payload = payload
+        self.headers = headers or {}
+
+    async def json(self, loads=None, content_type=None):
+        return self.payload
+
+    async def text(self):
+        return str(self.payload)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+class FakeSession:
+    """Stand-in for the shared RPC session, answering posts with canned responses."""
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.posts = 0
+
+    def post(self, url, data=None):
+        self.posts += 1
+        response = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+@contextlib.contextmanager
+def fake_session(responses):
+    """Route the RPC helpers through a fake session, restoring the real one afterwards."""
+    session = FakeSession(responses)
+    original = solana_payments.get_rpc_session
+
+    async def get_rpc_session():
+        return session
+
+    solana_payments.get_rpc_session = get_rpc_session
+    try:
+        yield session
+    finally:
+        solana_payments.get_rpc_session = original
+        solana_payments._endpoint_state.update(failures=0, open_until=0.0)
+
+def test_batch_responses_matched_by_id():
+    """Test that batch replies are matched to their calls by id, whatever their order."""
+    calls = [("getBalance", ["a"]), ("getBalance", ["b"]), ("getBalance", ["c"])]
+    # Replies come back out of order, and the one for the second call is missing
+    replies = [
+        {"jsonrpc": "2.0", "id": 2, "result": {"value": 30}},
+        {"jsonrpc": "2.0", "id": 0, "result": {"value": 10}},
+        {"jsonrpc": "2.0", "id": 7, "result": {"value": 99}},
+    ]
+    with fake_session([FakeResponse(200, replies)]):
+        responses = asyncio.run(solana_payments.make_rpc_batch_request(calls))
+    assert len(responses) == len(calls)
+    assert responses[0]['result']['value'] == 10
+    assert responses[1] is None, "A call without a reply should get None"
+    assert responses[2]['result']['value'] == 30
+
+def test_batch_error_shared():
+    """Test that an error for the whole batch is handed to every call."""
+    error = {"jsonrpc": "2.0", "id": None, "error": {"code": -32600, "message": "Invalid request"}}
+    with fake_session([FakeResponse(200, error)]):
+        responses = asyncio.run(solana_payments.make_rpc_batch_request([("getBalance", ["a"]), ("getBalance", ["b"])]))
+    assert responses == [error, error]
+    assert asyncio.run(solana_payments.make_rpc_batch_request([])) == []
+
+def test_retry_delay():
+    """Test the jittered backoff and its use of Retry-After."""
+    for attempt in range(3):
+        delay = solana_payments._rpc_retry_delay(1, attempt)
+        assert 0.5 * 2 ** attempt <= delay <= 1.5 * 2 ** attempt
+    assert solana_payments._rpc_retry_delay(1, 10) == solana_payments.RPC_RETRY_MAX_DELAY
+    assert solana_payments._rpc_retry_delay(1, 0, '3') == 3
+    assert solana_payments._rpc_retry_delay(1, 0, '3600') == solana_payments.RPC_RETRY_MAX_DELAY
+    assert 0.5 <= solana_payments._rpc_retry_delay(1, 0, 'soon') <= 1.5, "An unparseable Retry-After falls back to backoff"
+
+def test_circuit_opens_and_closes():
+    """Test that repeated failures open the circuit and a success after the cooldown closes it."""
+    threshold = solana_payments.RPC_CIRCUIT_FAILURE_THRESHOLD
+    with fake_session([FakeResponse(503, 'unavailable')]) as session:
+        result = asyncio.run(solana_payments.make_rpc_request("getHealth", retries=threshold + 2, retry_delay=0))
+        assert result is None
+        assert session.posts == threshold, "Retries should stop once the circuit opens"
+        assert solana_payments._rpc_circuit_open()
+
+        # While open, calls fail fast without reaching the node
+        assert asyncio.run(solana_payments.make_rpc_request("getHealth", retry_delay=0)) is None
+        assert asyncio.run(solana_payments.make_rpc_batch_request([("getHealth", [])], retry_delay=0)) == [None]
+        assert session.posts == threshold
+
+        # Once the cooldown has passed, a successful call closes the circuit again
+        solana_payments._endpoint_state['open_until'] = time.monotonic() - 1
+        session.responses = [FakeResponse(200, {"jsonrpc": "2.0", "id": 1, "result": "ok"})]
+        result = asyncio.run(solana_payments.make_rpc_request("getHealth", retry_delay=0))
+        assert result['result'] == 'ok'
+        assert not solana_payments._rpc_circuit_open()
+        assert solana_payments._endpoint_state['failures'] == 0
+
+def test_success_resets_failures():
+    """Test that a reply from the node, even an RPC error, resets the failure count."""
+    rpc_error = {"jsonrpc": "2.0", "id": 1, "error": {"code": -32602, "message": "Invalid params"}}
+    with fake_session([FakeResponse(429, 'slow down', {'Retry-After': '0'}), TimeoutError(), FakeResponse(200, rpc_error)]) as session:
+        result = asyncio.run(solana_payments.make_rpc_request("getBalance", ["a"], retries=3, retry_delay=0))
+        assert result == rpc_error, "RPC errors are returned to the caller"
+        assert session.posts == 3
+        assert solana_payments._endpoint_state['failures'] == 0
+        assert not solana_payments._rpc_circuit_open()
+
+def test_load_token_decimals():
+    """Test that the token scale follows the mint's on-chain decimals, not the environment."""
+    original_decimals = solana_payments.SPL_TOKEN_DECIMALS
+    solana_payments._set_token_decimals(9)
+    solana_payments._token_decimals_loaded = False
+    try:
+        # A failed lookup keeps the configured value and is retried later
+        with fake_session([FakeResponse(200, {"jsonrpc": "2.0", "id": 1, "error": {"code": -32602, "message": "Invalid param"}})]):
+            assert asyncio.run(solana_payments.load_token_decimals()) is False
+            assert solana_payments.TOKEN_SCALE == 10 ** 9
+
+        supply = {"jsonrpc": "2.0", "id": 1, "result": {"value": {"amount": "1000000000", "decimals": 6}}}
+        with fake_session([FakeResponse(200, supply)]) as session:
+            assert asyncio.run(solana_payments.load_token_decimals()) is True
+            assert solana_payments.SPL_TOKEN_DECIMALS == 6
+            assert solana_payments.TOKEN_SCALE == 10 ** 6
+            assert solana_payments.RAW_UNITS_THRESHOLD == 10 ** 5
+
+            # The decimals are only read from the chain once
+            assert asyncio.run(solana_payments.load_token_decimals()) is True
+            assert session.posts == 1
+    finally:
+        solana_payments._set_token_decimals(original_decimals)
+        solana_payments._token_decimals_loaded = False
+
+def main():
+    logger.info("Starting Solana RPC helper tests...")
+    test_decode_token_amount()
+    test_decode_token_amount_malformed()
+    test_batch_responses_matched_by_id()
+    test_batch_error_shared()
+    test_retry_delay()
+    test_circuit_opens_and_closes()
+    test_success_resets_failures()
+    test_load_token_decimals()
+    logger.info("All Solana RPC helper tests passed.")
+
+if __name__ == "__main__":
+    main()
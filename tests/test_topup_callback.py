@@ -0,0 +1,63 @@
+import os
+import logging
+
+# Set environment variables for testing before importing the bot
+os.environ['TESTING_MODE'] = 'true'
+os.environ['MOCK_PAYMENT_SUCCESS'] = 'false'
+os.environ['SPL_TOKEN_SYMBOL'] = 'TEST'
+os.environ.setdefault('AIRALO_CLIENT_ID', 'test_client_id')  # The bot builds its Airalo client at import
+os.environ.setdefault('AIRALO_CLIENT_SECRET', 'test_client_secret')
+
+# Import after setting environment variables
+from bot import TOPUP_CALLBACK_RE
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def test_usage_callback():
+    """Test the topup button under a usage message."""
+    match = TOPUP_CALLBACK_RE.match('topup_usage_8944500102198304826')
+    assert match is not None
+    assert match['usage_iccid'] == '8944500102198304826'
+    assert match['package_id'] is None
+
+def test_cents_callback():
+    """Test the current format, with the original price in cents."""
+    match = TOPUP_CALLBACK_RE.match('topup_discover-7days-1gb-topup_450')
+    assert match is not None
+    assert match['package_id'] == 'discover-7days-1gb-topup'
+    assert match['price_cents'] == '450'
+    assert match['original_price'] is None
+    assert match['marked_up_price'] is None
+    assert int(match['price_cents']) / 100 == 4.5
+
+def test_legacy_callback():
+    """Test the legacy format, with prices in dollars and an optional marked up price."""
+    match = TOPUP_CALLBACK_RE.match('topup_discover-7days-1gb_4.5')
+    assert match is not None
+    assert match['package_id'] == 'discover-7days-1gb'
+    assert match['price_cents'] is None
+    assert match['original_price'] == '4.5'
+    assert match['marked_up_price'] is None
+
+    match = TOPUP_CALLBACK_RE.match('topup_discover-7days-1gb_4.50_7.61')
+    assert match is not None
+    assert match['original_price'] == '4.50'
+    assert match['marked_up_price'] == '7.61'
+
+def test_invalid_callbacks():
+    """Test that malformed topup callback data doesn't match."""
+    for data in ('topup_', 'topup_package', 'topup_package_', 'topup_package_abc', 'check_payment_abc', 'topup_package_4.5_'):
+        assert TOPUP_CALLBACK_RE.match(data) is None, f"{data!r} should not match"
+
+def main():
+    logger.info("Starting topup callback parsing tests...")
+    test_usage_callback()
+    test_cents_callback()
+    test_legacy_callback()
+    test_invalid_callbacks()
+    logger.info("All topup callback parsing tests passed.")
+
+if __name__ == "__main__":
+    main()